@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import tracemalloc
+import zipfile
+import argparse
+import tempfile
+import importlib
+from io import BytesIO
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+# metaguiding.py uses a relative import, so it is loaded as part of the _common package. It is imported by name so
+# that mypy, which checks _common/metaguiding.py as the top-level module metaguiding, does not find it twice
+metaguiding = importlib.import_module("_common.metaguiding")
+
+# Type definitions
+Document = Tuple[str, bytes]
+
+_WORDS = (
+    "the of and to in a is that for it as was with be by on not he I this are or his from at which but have an they "
+    "you were her she there been one all we their has would when if so no what up out who them some into more time "
+    "reading focus metaguided intellireading calibre omnibus chapter ação naïve façade 日本語 über"
+).split()
+_ENTITIES = ["&amp;", "&#8212;", "&#160;", "&lt;", "&#x201C;"]
+
+
+def generate_xhtml_document(paragraphs: int, seed: int = 0) -> bytes:
+    """Generate a synthetic XHTML content document with a realistic mix of markup, entities and words."""
+    rnd = random.Random(seed)
+    body = []
+    for index in range(paragraphs):
+        words = []
+        for _ in range(rnd.randint(20, 120)):
+            roll = rnd.random()
+            if roll < 0.03:
+                words.append(rnd.choice(_ENTITIES))
+            elif roll < 0.06:
+                words.append(f"<i>{rnd.choice(_WORDS)}</i>")
+            elif roll < 0.07:
+                words.append("<br/>" + rnd.choice(_WORDS))
+            else:
+                words.append(rnd.choice(_WORDS))
+        body.append(f'<p class="p{index % 5}" id="p{index}">{" ".join(words)}.</p>')
+        if index % 25 == 0:
+            body.append(f'<h2>Chapter {index // 25}</h2><img alt="figure {index}" src="img{index}.jpg"/>')
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Benchmark &amp; test</title></head>\n'
+        '<body class="text">\n' + "\n".join(body) + "\n</body></html>"
+    ).encode("utf-8")
+
+
+# markup fragments that made the regex engines backtrack quadratically when repeated in long runs
+_PATHOLOGICAL_FRAGMENTS = (
+    "<",
+    ">",
+    "<b",
+    "<b>",
+    "</b>",
+    "<br/>",
+    "<body>",
+    "</body",
+    "</body>",
+    "<p>",
+    "</p>",
+    "a",
+    "word ",
+    " ",
+    "\n",
+    "&",
+    "&#",
+    "&amp;",
+    "#a",
+)
+
+
+def generate_pathological_document(size: int, seed: int) -> Tuple[str, bytes]:
+    """Generate a XHTML document whose body repeats one or two random units of markup fragments, with or
+    without a closing </body>, for a body of about size characters. The units only depend on the seed,
+    so the same seed gives the same kind of document at any size.
+    """
+    rnd = random.Random(seed)
+    units = ["".join(rnd.choices(_PATHOLOGICAL_FRAGMENTS, k=rnd.randint(1, 4))) for _ in range(rnd.randint(1, 2))]
+    body = "".join(unit * (size // len(units) // len(unit) + 1) for unit in units)
+    body_close = rnd.choice(("</body>", ""))
+    name = f"seed {seed}: {' then '.join(units)!r}{'' if body_close else ' (no </body>)'}"
+    return name, ("<html><body>" + body + body_close + "</html>").encode("utf-8")
+
+
+def generate_corpus(documents: int, paragraphs: int) -> List[Document]:
+    """Generate a deterministic golden corpus of synthetic documents."""
+    return [(f"synthetic-{i}.xhtml", generate_xhtml_document(paragraphs, seed=i)) for i in range(documents)]
+
+
+_CONTAINER_XML = (
+    '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+    "</container>"
+)
+
+
+def generate_package_document(chapters: int) -> str:
+    """Generate the OPF package document of generate_epub, with every chapter in the spine."""
+    items = "".join(
+        f'<item id="chapter{index}" href="chapter{index}.xhtml" media-type="application/xhtml+xml"/>'
+        for index in range(chapters)
+    )
+    itemrefs = "".join(f'<itemref idref="chapter{index}"/>' for index in range(chapters))
+    return (
+        '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+        f"<manifest>{items}</manifest><spine>{itemrefs}</spine></package>"
+    )
+
+
+def generate_epub(path: Path, chapters: int, paragraphs: int, image_mb: int, *, metaguided: bool = False) -> None:
+    """Write a synthetic epub with chapters and 4 incompressible images taking image_mb MB in total."""
+    rnd = random.Random(0)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+        epub.writestr("META-INF/container.xml", _CONTAINER_XML)
+        epub.writestr("OEBPS/content.opf", generate_package_document(chapters))
+        for index in range(chapters):
+            epub.writestr(f"OEBPS/chapter{index}.xhtml", generate_xhtml_document(paragraphs, seed=index))
+        for index in range(4):
+            epub.writestr(f"OEBPS/image{index}.jpg", rnd.randbytes(image_mb * 1024 * 1024 // 4))
+        if metaguided:
+            epub.writestr(metaguiding._METAGUIDED_FLAG_FILENAME, "version: benchmark")
+
+
+def load_corpus(paths: List[str]) -> List[Document]:
+    """Load the XHTML content documents of the given epub/xhtml files."""
+    corpus: List[Document] = []
+    for path in map(Path, paths):
+        if path.suffix.upper() in metaguiding._EPUB_EXTENSIONS:
+            with zipfile.ZipFile(path) as epub:
+                for info in epub.infolist():
+                    if Path(info.filename).suffix.upper() in metaguiding._XHTML_EXTENSIONS:
+                        corpus.append((f"{path.name}:{info.filename}", epub.read(info)))
+        else:
+            corpus.append((path.name, path.read_bytes()))
+    return corpus
+
+
+def time_engine(engine: Callable[[bytes], bytes], corpus: List[Document], repeat: int) -> float:
+    """Return the best wall time of processing the whole corpus with the engine."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _, document in corpus:
+            engine(document)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def verify_engines(reference, candidate, corpus: List[Document]) -> bool:
+    """Check the candidate engine produces byte-identical output to the reference engine."""
+    identical = True
+    for name, document in corpus:
+        if reference.metaguide_xhtml_document(document) != candidate.metaguide_xhtml_document(document):
+            print(f"Error: {type(candidate).__name__} output differs from {type(reference).__name__} for {name}")
+            identical = False
+    return identical
+
+
+def peak_memory(engine: Callable[[bytes], bytes], document: bytes) -> int:
+    """Return the peak memory allocated while the engine processes the document, in bytes."""
+    tracemalloc.start()
+    try:
+        engine(document)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class NullWriter:
+    """A writable that discards the data, like a file on disk it does not keep the output in memory."""
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+def benchmark_memory(paragraphs: int) -> None:
+    """Report the peak memory of each engine on a large single-file book, relative to its size."""
+    document = generate_xhtml_document(paragraphs)
+    document_mb = len(document) / 1024 / 1024
+    print(f"Single-file book: {document_mb:.2f} MB")
+    for engine in (metaguiding.RegExBoldMetaguider(), metaguiding.TokenizerBoldMetaguider()):
+        peak_mb = peak_memory(engine.metaguide_xhtml_document, document) / 1024 / 1024
+        print(f"{type(engine).__name__:<28} {peak_mb:8.2f} MB peak {peak_mb / document_mb:6.2f}x the book size")
+
+    engine = metaguiding.TokenizerBoldMetaguider()
+    stream = partial(engine.metaguide_xhtml_document_stream, output_stream=NullWriter())
+    peak_mb = peak_memory(lambda document: stream(BytesIO(document)), document) / 1024 / 1024
+    print(f"{'Streaming (64 KB chunks)':<28} {peak_mb:8.2f} MB peak {peak_mb / document_mb:6.2f}x the book size")
+
+
+def benchmark_flag_check(repeat: int) -> None:
+    """Report the time of is_file_metaguided on books of growing size with the same entries.
+    Only the zip central directory is read, so the time does not depend on the size of the book.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        for image_mb in (1, 8, 64):
+            for metaguided in (False, True):
+                path = Path(directory) / f"book-{image_mb}-{metaguided}.epub"
+                generate_epub(path, chapters=20, paragraphs=100, image_mb=image_mb, metaguided=metaguided)
+                book_mb = path.stat().st_size / 1024 / 1024
+                best = float("inf")
+                for _ in range(repeat * 10):
+                    start = time.perf_counter()
+                    metaguiding.is_file_metaguided(str(path))
+                    best = min(best, time.perf_counter() - start)
+                print(f"{book_mb:8.2f} MB book, metaguided={metaguided!s:<5} is_file_metaguided {best * 1e6:10.1f} us")
+
+
+def benchmark_compression(paragraphs: int, repeat: int) -> None:
+    """Report the time and output size of metaguide_epub_file for each compression policy.
+    The images are incompressible, like real jpeg/png images, so recompressing them only costs time.
+    The compressed documents are compressed in parallel when the machine has more than one cpu.
+    """
+    policies = [
+        ("deflate (default), others copied", {}),
+        ("stored, others copied", {"compression": zipfile.ZIP_STORED}),
+        ("deflate 1, others copied", {"compresslevel": 1}),
+        ("deflate 6, others copied", {"compresslevel": 6}),
+        ("deflate 9, others copied", {"compresslevel": 9}),
+        (
+            "deflate 9, others deflate 9",
+            {"compresslevel": 9, "other_compression": zipfile.ZIP_DEFLATED, "other_compresslevel": 9},
+        ),
+        ("stored, others stored", {"compression": zipfile.ZIP_STORED, "other_compression": zipfile.ZIP_STORED}),
+        ("deflate 9, 1 compression thread", {"compresslevel": 9, "compression_threads": 1}),
+        (
+            f"deflate 9, default ({metaguiding._DEFAULT_COMPRESSION_THREADS}) threads",
+            {"compresslevel": 9, "compression_threads": metaguiding._DEFAULT_COMPRESSION_THREADS},
+        ),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        book = Path(directory) / "book.epub"
+        output = Path(directory) / "output.epub"
+        generate_epub(book, chapters=20, paragraphs=paragraphs, image_mb=16)
+        print(f"{'input book':<34} {'':>10} {book.stat().st_size / 1024 / 1024:10.2f} MB")
+        for name, options in policies:
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                metaguiding.metaguide_epub_file(str(book), str(output), **options)
+                best = min(best, time.perf_counter() - start)
+            print(f"{name:<34} {best:8.3f} s {output.stat().st_size / 1024 / 1024:10.2f} MB")
+
+
+def benchmark_workers(max_workers: int, repeat: int) -> None:
+    """Report the time of metaguide_epub_file on a large book for 1 to max_workers worker processes."""
+    with tempfile.TemporaryDirectory() as directory:
+        book = Path(directory) / "book.epub"
+        output = Path(directory) / "output.epub"
+        generate_epub(book, chapters=200, paragraphs=400, image_mb=4)
+        baseline = None
+        for workers in range(1, max_workers + 1):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                metaguiding.metaguide_epub_file(str(book), str(output), workers=workers)
+                best = min(best, time.perf_counter() - start)
+            baseline = baseline or best
+            print(f"{workers:3d} workers {best:8.3f} s  speedup {baseline / best:5.2f}x")
+
+
+def benchmark_jobs(max_jobs: int, books: int, paragraphs: int) -> None:
+    """Report the time of metaguide_dir on a directory of synthetic books for 1 to max_jobs worker processes,
+    with and without the asyncio pipeline overlapping the reads and writes with the metaguiding.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        library = Path(directory) / "library"
+        library.mkdir()
+        for index in range(books):
+            generate_epub(library / f"book{index}.epub", chapters=20, paragraphs=paragraphs, image_mb=1)
+        library_mb = sum(path.stat().st_size for path in library.iterdir()) / 1024 / 1024
+        print(f"{books} books, {library_mb:.2f} MB")
+        baseline = None
+        for jobs in range(1, max_jobs + 1):
+            for pipeline in (False, True):
+                output = Path(directory) / f"output-{jobs}-{pipeline}"
+                start = time.perf_counter()
+                report = metaguiding.metaguide_dir(str(library), str(output), jobs=jobs, pipeline=pipeline)
+                elapsed = time.perf_counter() - start
+                baseline = baseline or elapsed
+                totals = report.to_dict()
+                print(
+                    f"{jobs:3d} jobs pipeline={pipeline!s:<5} {elapsed:8.3f} s {books / elapsed:8.2f} books/s "
+                    f"{library_mb / elapsed:8.2f} MB/s {totals['words_per_second']:10.0f} words/s "
+                    f"cpu {totals['cpu_time']:7.3f} s  peak RSS {(totals['peak_rss'] or 0) / 1024 / 1024:7.1f} MB  "
+                    f"speedup {baseline / elapsed:5.2f}x"
+                )
+
+
+def benchmark_word_cache(corpus: List[Document], repeat: int, cache_size: int) -> None:
+    """Compare the engines with the word cache disabled and enabled, on throughput and memory."""
+    corpus_mb = sum(len(document) for _, document in corpus) / 1024 / 1024
+    print(f"Corpus: {len(corpus)} documents, {corpus_mb:.2f} MB")
+    for engine_class in (metaguiding.RegExBoldMetaguider, metaguiding.TokenizerBoldMetaguider):
+        for size in (0, cache_size):
+            engine = engine_class(word_cache_size=size)
+            elapsed = time_engine(engine.metaguide_xhtml_document, corpus, repeat)
+
+            # the cache is kept between documents, so the peak and the statistics are measured over one
+            # pass on the whole corpus, starting with an empty cache
+            engine.clear_word_cache()
+            engine.stats.clear()
+            tracemalloc.start()
+            for _, document in corpus:
+                engine.metaguide_xhtml_document(document)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+
+            lookups = engine.stats["word_cache_hits"] + engine.stats["word_cache_misses"]
+            hit_rate = f"{engine.stats['word_cache_hits'] / lookups:6.1%} hits" if lookups else "  no cache"
+            print(
+                f"{engine_class.__name__:<28} cache={size:<7} {elapsed:8.3f} s {corpus_mb / elapsed:8.2f} MB/s "
+                f"{peak_mb:8.2f} MB peak {hit_rate} {engine.stats['word_cache_evictions']} evictions"
+            )
+
+
+def benchmark_removal(corpus: List[Document], repeat: int) -> bool:
+    """Compare the removal of the metaguiding by the regex engine and by the tokenizer engine."""
+    bolded_corpus = [
+        (name, metaguiding.TokenizerBoldMetaguider().metaguide_xhtml_document(doc)) for name, doc in corpus
+    ]
+    bolded_mb = sum(len(document) for _, document in bolded_corpus) / 1024 / 1024
+    print(f"Metaguided corpus: {len(bolded_corpus)} documents, {bolded_mb:.2f} MB")
+    baseline = None
+    for engine in (metaguiding.RegExBoldMetaguider(), metaguiding.TokenizerBoldMetaguider()):
+        remove = partial(engine.metaguide_xhtml_document, remove_metaguiding=True)
+        for (name, document), (_, bolded) in zip(corpus, bolded_corpus):
+            if remove(bolded) != document:
+                print(f"Error: {type(engine).__name__} does not restore {name}")
+                return False
+        elapsed = time_engine(remove, bolded_corpus, repeat)
+        baseline = baseline or elapsed
+        print(
+            f"{type(engine).__name__:<28} {elapsed:8.3f} s {bolded_mb / elapsed:8.2f} MB/s {baseline / elapsed:6.2f}x "
+            f"{dict(engine.stats)}"
+        )
+    return True
+
+
+def stream_document(engine, document: bytes) -> bytes:
+    """Metaguide a document through the streaming API of the engine."""
+    output = BytesIO()
+    engine.metaguide_xhtml_document_stream(BytesIO(document), output)
+    return output.getvalue()
+
+
+def benchmark_pathological(engine_names: List[str], size: int, documents: int, seed: int, max_growth: float) -> bool:
+    """Check the engines stay linear on random pathological documents, see generate_pathological_document.
+    Each document is bolded, unbolded and streamed by each engine at size / 4 and at size: a linear engine
+    takes about 4 times as long on the larger one, a quadratic one 16 times. Times under 10 ms are too noisy
+    to tell, so they always pass. The streamed output must be the same as the document output.
+    """
+    passed = True
+    print(f"{'engine':<28} {'bold':>6} {'remove':>6} {'stream':>6}  growth of the time for a 4 times larger document")
+    for document_seed in range(seed, seed + documents):
+        name, small = generate_pathological_document(size // 4, document_seed)
+        _, large = generate_pathological_document(size, document_seed)
+        print(name)
+        for engine_name in engine_names:
+            engine = metaguiding.create_metaguiding_engine(engine_name)
+            stream = partial(stream_document, engine)
+            growths = []
+            failed = False
+            for metaguide in (
+                engine.metaguide_xhtml_document,
+                partial(engine.metaguide_xhtml_document, remove_metaguiding=True),
+                stream,
+            ):
+                # the best of two runs, so the first one can import and warm up the engine
+                small_elapsed = time_engine(metaguide, [(name, small)], 2)
+                large_elapsed = time_engine(metaguide, [(name, large)], 2)
+                growths.append(large_elapsed / max(small_elapsed, 1e-6))
+                failed = failed or (large_elapsed > 0.01 and growths[-1] > max_growth)
+
+            if stream(large) != engine.metaguide_xhtml_document(large):
+                print(f"Error: {type(engine).__name__} streams a different output")
+                failed = True
+
+            passed = passed and not failed
+            print(
+                f"{type(engine).__name__:<28} {growths[0]:6.1f} {growths[1]:6.1f} {growths[2]:6.1f}"
+                f"{'  FAILED' if failed else ''}"
+            )
+
+    if not passed:
+        print("Error: some engines are not linear on pathological documents, rerun with --seed to reproduce")
+    return passed
+
+
+def benchmark_engines(engine_names: List[str], corpus: List[Document], repeat: int) -> bool:
+    """Compare the engines on throughput, peak memory and output size, the first engine is the baseline.
+    The tokenizer engine must be byte-identical to the regex engine, the lxml engine re-serializes the documents.
+    """
+    reference = metaguiding.RegExBoldMetaguider()
+    if not verify_engines(reference, metaguiding.TokenizerBoldMetaguider(), corpus):
+        return False
+
+    corpus_mb = sum(len(document) for _, document in corpus) / 1024 / 1024
+    largest = max((document for _, document in corpus), key=len)
+    print(f"Corpus: {len(corpus)} documents, {corpus_mb:.2f} MB, the tokenizer output is byte-identical")
+    print(f"{'engine':<28} {'time':>10} {'throughput':>13} {'speedup':>7} {'peak (largest doc)':>19} {'output':>11}")
+    baseline = None
+    for engine_name in engine_names:
+        engine = metaguiding.create_metaguiding_engine(engine_name)
+        elapsed = time_engine(engine.metaguide_xhtml_document, corpus, repeat)
+        baseline = baseline or elapsed
+        peak_mb = peak_memory(engine.metaguide_xhtml_document, largest) / 1024 / 1024
+        output_mb = sum(len(engine.metaguide_xhtml_document(document)) for _, document in corpus) / 1024 / 1024
+        print(
+            f"{type(engine).__name__:<28} {elapsed:8.3f} s {corpus_mb / elapsed:8.2f} MB/s {baseline / elapsed:6.2f}x "
+            f"{peak_mb:16.2f} MB {output_mb:8.2f} MB"
+        )
+        print(
+            f"{'':<28} bytes={engine.supports_bytes} streaming={engine.supports_streaming} "
+            f"thread_safe={engine.thread_safe} code paths: {dict(getattr(engine, 'stats', {}))}"
+        )
+    return True
+
+
+def main() -> None:
+    """Main function to benchmark the metaguiding engines."""
+    parser = argparse.ArgumentParser(description="Benchmark the metaguiding engines")
+    parser.add_argument("files", nargs="*", help="epub/xhtml files to use instead of the synthetic corpus")
+    parser.add_argument("--documents", type=int, default=20, help="number of synthetic documents")
+    parser.add_argument("--paragraphs", type=int, default=400, help="paragraphs per synthetic document")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs, the best one is reported")
+    parser.add_argument(
+        "--memory", type=int, metavar="PARAGRAPHS", help="benchmark peak memory on a single-file book instead"
+    )
+    parser.add_argument(
+        "--word-cache", type=int, metavar="SIZE", help="compare the engines with and without a word cache of SIZE"
+    )
+    parser.add_argument(
+        "--flag-check", action="store_true", help="benchmark is_file_metaguided on books of growing size instead"
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=metaguiding.get_metaguiding_engines(),
+        default=metaguiding.get_metaguiding_engines(),
+        help="registered engines to compare (default: all)",
+    )
+    parser.add_argument(
+        "--compression",
+        type=int,
+        metavar="PARAGRAPHS",
+        help="compare the epub compression policies on a book with chapters of PARAGRAPHS instead",
+    )
+    parser.add_argument(
+        "--workers", type=int, metavar="N", help="compare 1 to N worker processes metaguiding a large book instead"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="compare metaguide_dir with 1 to N worker processes, with and without the pipeline, on --documents "
+        "synthetic books instead",
+    )
+    parser.add_argument("--remove", action="store_true", help="benchmark the removal of the metaguiding instead")
+    parser.add_argument(
+        "--pathological",
+        type=int,
+        metavar="SIZE",
+        help="check the engines stay linear on --documents random pathological documents of SIZE characters instead",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first document of --pathological")
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=8.0,
+        help="maximum growth of the time allowed by --pathological for a 4 times larger document (default: 8.0)",
+    )
+    args = parser.parse_args()
+
+    if args.flag_check:
+        benchmark_flag_check(args.repeat)
+        return
+
+    if args.pathological:
+        if not benchmark_pathological(args.engines, args.pathological, args.documents, args.seed, args.max_growth):
+            sys.exit(1)
+        return
+
+    if args.jobs:
+        benchmark_jobs(args.jobs, args.documents, args.paragraphs)
+        return
+
+    if args.workers:
+        benchmark_workers(args.workers, args.repeat)
+        return
+
+    if args.compression:
+        benchmark_compression(args.compression, args.repeat)
+        return
+
+    if args.memory:
+        benchmark_memory(args.memory)
+        return
+
+    corpus = load_corpus(args.files) if args.files else generate_corpus(args.documents, args.paragraphs)
+    if args.word_cache:
+        benchmark_word_cache(corpus, args.repeat, args.word_cache)
+        return
+
+    if args.remove:
+        passed = benchmark_removal(corpus, args.repeat)
+    else:
+        passed = benchmark_engines(args.engines, corpus, args.repeat)
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
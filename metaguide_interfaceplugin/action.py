@@ -164,7 +164,7 @@ class InterfacePlugin(InterfaceAction):
                 self.gui.status_bar.show_message(log_message, 1000)
                 return True
 
-            metaguiding.metaguide_epub_file(temp_file, temp_file, remove_metaguiding=remove_metaguiding)
+            metaguiding.metaguide_epub_file(temp_file, remove_metaguiding=remove_metaguiding)
         except Exception as e:  # pylint: disable=broad-except
             log_message = f"Error processing book '{book_title}', format: {format_to_find}, error details: {e}"
             common.log.error(log_message)
@@ -19,7 +19,8 @@ MSG_ALREADY_METAGUIDED = (
 def metaguide_file(filepath: str) -> str:
     common.log.debug(f"Converting file to metaguiding format: {filepath}")
     try:
-        metaguiding.metaguide_epub_file(filepath, filepath, remove_metaguiding=False)
+        if not metaguiding.metaguide_epub_file(filepath, remove_metaguiding=False):
+            common.log.debug(f"File is already metaguided, left unchanged: {filepath}")
     except Exception as e:  # pylint: disable=broad-except
         common.log.error(f"Error processing file: {filepath}")
         common.log.error(str(e))
@@ -1,23 +1,81 @@
+import asyncio
 import logging
 from io import BytesIO
 import os
 import sys
+import time
 import traceback
+import uuid
 import zipfile
-from typing import Generator
+import codecs
+import contextlib
+import hashlib
+import itertools
+import json
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, BinaryIO, Callable, Generator, Iterable, Protocol, cast, runtime_checkable
+from functools import partial
 import math
+import posixpath
+from xml.etree import ElementTree
+from urllib.parse import unquote
 import regex as re
 
 # relative import is used to ensure that when this module gets copied to another location
 # it still works
 from .__about_cli__ import __version__ as cli_version  # noqa: TID252
 
-
 _logger = logging.getLogger(__name__)
 _METAGUIDED_FLAG_FILENAME = "intellireading.metaguide"
 _EPUB_EXTENSIONS = [".EPUB", ".KEPUB"]
 _XHTML_EXTENSIONS = [".XHTML", ".HTML", ".HTM"]
 _TOC_FILENAMES = ["nav.xhtml", "nav.html", "toc.xhtml", "toc.html"]
+_EPUB_MIMETYPE_FILENAME = "mimetype"
+_EPUB_CONTAINER_FILENAME = "META-INF/container.xml"
+_XHTML_MEDIA_TYPES = ("application/xhtml+xml", "text/html")
+# the only compression methods allowed in an epub (OCF) container
+_EPUB_COMPRESSIONS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+_STREAM_CHUNK_SIZE = 64 * 1024
+# a streamed body is held until its </body> shows up, in memory up to this size and then in a temporary file
+_STREAM_HOLD_MEMORY_SIZE = 256 * 1024
+_ENCODING_SNIFF_SIZE = 4 * 1024
+# the BOM, or the first '<', of the encodings that are not ASCII based. UTF-32 is tested before UTF-16
+_WIDE_ENCODING_PREFIXES = (
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (b"\x00\x00\x00\x3c", "utf-32-be"),
+    (b"\x3c\x00\x00\x00", "utf-32-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (b"\x00\x3c", "utf-16-be"),
+    (b"\x3c\x00", "utf-16-le"),
+)
+_ZIP_ENCRYPTED_FLAG = 0x01
+_ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+_ZIP64_EXTRA_ID = 0x0001
+# the local file header of a zip entry (APPNOTE 4.3.7), and the indexes of its name and extra field lengths
+_ZIP_LOCAL_HEADER_STRUCT = "<4s2B4HL2L2H"
+_ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+_ZIP_LOCAL_HEADER_SIZE = struct.calcsize(_ZIP_LOCAL_HEADER_STRUCT)
+_ZIP_LOCAL_HEADER_NAME_LENGTH = 10
+_ZIP_LOCAL_HEADER_EXTRA_LENGTH = 11
+# zlib releases the GIL while compressing, so the output entries are compressed by a few threads
+_DEFAULT_COMPRESSION_THREADS = min(8, os.cpu_count() or 1)
+# under this total size of xhtml documents, starting the worker processes costs more than it saves
+_PROCESS_POOL_MIN_SIZE = 4 * 1024 * 1024
+# small chapters are sent to the worker processes in batches of about this size, to amortise the IPC
+_PROCESS_POOL_BATCH_SIZE = 512 * 1024
+_DIR_MANIFEST_FILENAME = ".intellireading-manifest.jsonl"
+# files waiting between two stages of the metaguide_dir pipeline, and tasks reading or writing files at once
+_PIPELINE_QUEUE_SIZE = 4
+_PIPELINE_IO_TASKS = 2
+# the engine throughput of the metaguide_dir estimate is timed on this much of a document
+_THROUGHPUT_SAMPLE_SIZE = 256 * 1024
 
 
 def _generate_flag_file_content() -> bytes:
@@ -56,16 +114,94 @@ def _generate_flag_file_content() -> bytes:
         return f"version: {cli_version}\nprocess: unknown\ncall_graph: error".encode()
 
 
+@runtime_checkable
+class MetaguidingEngine(Protocol):
+    """What the metaguide_* functions need from an engine.
+
+    supports_bytes: bool
+        The engine works on the encoded document, without decoding it whole
+    supports_streaming: bool
+        metaguide_xhtml_document_stream processes the document in bounded memory, instead of reading it whole
+    thread_safe: bool
+        metaguide_xhtml_document can be called from several threads at once on the same engine
+    """
+
+    supports_bytes: bool
+    supports_streaming: bool
+
+    @property
+    def thread_safe(self) -> bool: ...
+
+    def metaguide_xhtml_document(self, xhtml_document: bytes, *, remove_metaguiding: bool = False) -> bytes:
+        """Bold the words of the document, or remove the bolding if remove_metaguiding is True"""
+        ...
+
+    def metaguide_xhtml_document_stream(
+        self, input_stream: BinaryIO, output_stream: BinaryIO, *, remove_metaguiding: bool = False
+    ) -> None:
+        """Same as metaguide_xhtml_document, reading from input_stream and writing to output_stream"""
+        ...
+
+
 class RegExBoldMetaguider:
-    _body_regex = re.compile(r"<body[^>]*>(.*)</body>", re.DOTALL)
-    _text_block_regex = re.compile(r"(?<!<b[^>]*)>[^\S]*[^\s<][^<]*[^\S\n]*<")
+    # capability flags of the MetaguidingEngine protocol
+    supports_bytes = False
+    supports_streaming = False
+
     _bolded_text_block_regex = re.compile(r"<b>\b\w{1}\b</b>|<b>\b\w+\b</b>(?:\b\w+\b)")
     _word_pattern_regex = re.compile(r"\b\w+\b", re.UNICODE)
     _entity_ref_regex = re.compile(r"(&[#a-zA-Z][a-zA-Z0-9]*;)")
     _bolded_word_regex = re.compile(r"<b>(.*?)</b>")
+    _meta_charset_regex = re.compile(rb"""<meta\s[^>]*?charset\s*=\s*["']?([a-zA-Z0-9_:.-]+)""", re.IGNORECASE)
+    _appendix_f_prefixes = (
+        (b"\x00\x00\x00\x3c", "utf-32-be"),
+        (b"\x3c\x00\x00\x00", "utf-32-le"),
+        # Appendix F lists "<?" for UTF-16, but documents without a declaration start with any tag
+        (b"\x00\x3c", "utf-16-be"),
+        (b"\x3c\x00", "utf-16-le"),
+        # "<?xm": the xml declaration has no encoding, so the document is UTF-8
+        (b"\x3c\x3f\x78\x6d", "utf-8"),
+    )
 
-    def __init__(self, fallback_encoding: str = "utf-8") -> None:
+    def __init__(self, fallback_encoding: str = "utf-8", word_cache_size: int = 0) -> None:
+        """
+        fallback_encoding: str
+            The encoding used when it cannot be detected from the document
+        word_cache_size: int
+            Maximum number of bolded words kept in a LRU cache. 0 disables the cache
+        """
         self._fallback_encoding = fallback_encoding
+        # counters of the code paths taken by this engine, useful for instrumentation
+        self.stats: Counter = Counter()
+        # words follow a Zipf distribution, so most of the words are repeats of a few frequent ones
+        self._word_cache_size = word_cache_size
+        self._word_cache: OrderedDict = OrderedDict()
+
+    @property
+    def thread_safe(self) -> bool:
+        # the LRU cache is reordered on every lookup. The stats counters may miss increments
+        # when shared between threads, but they are only used for instrumentation
+        return self._word_cache_size == 0
+
+    def clear_word_cache(self) -> None:
+        """Empty the word cache, e.g. to scope it to a single book. The statistics are kept."""
+        self._word_cache.clear()
+
+    def _get_cached_word(self, word):
+        # returns the bolded word, or None if the word is not in the cache
+        bolded = self._word_cache.get(word)
+        if bolded is None:
+            self.stats["word_cache_misses"] += 1
+        else:
+            self.stats["word_cache_hits"] += 1
+            self._word_cache.move_to_end(word)
+        return bolded
+
+    def _add_cached_word(self, word, bolded) -> None:
+        self._word_cache[word] = bolded
+        if len(self._word_cache) > self._word_cache_size:
+            self._word_cache.popitem(last=False)
+            self.stats["word_cache_evictions"] += 1
 
     def _bold_word(self, word: str) -> str:
         # this is the function that is called for each word
@@ -74,6 +210,16 @@ class RegExBoldMetaguider:
         if not word.strip():
             return word
 
+        if self._word_cache_size > 0:
+            bolded = self._get_cached_word(word)
+            if bolded is None:
+                bolded = self._bold_uncached_word(word)
+                self._add_cached_word(word, bolded)
+            return bolded
+
+        return self._bold_uncached_word(word)
+
+    def _bold_uncached_word(self, word: str) -> str:
         word_length = len(word)
         midpoint = 1 if word_length in (1, 3) else math.ceil(word_length / 2)
         return f"<b>{word[:midpoint]}</b>{word[midpoint:]}"  # Bold the first half of the word
@@ -119,35 +265,89 @@ class RegExBoldMetaguider:
             return ">" + new_node_text + "<"
         return node
 
+    def _find_body_span(self, html) -> tuple[int, int] | None:
+        """Return the (start, end) span of the content of the body, or None if there is no body.
+        The body ends at the last </body>. html can be either str or bytes.
+        Only find and rfind are used, so this is linear even on documents with many <body> tags
+        and no </body>, where a regex like <body[^>]*>(.*)</body> is retried at every <body>.
+        """
+        body_mark, gt_mark, body_close_mark = (
+            ("<body", ">", "</body>") if isinstance(html, str) else (b"<body", b">", b"</body>")
+        )
+        start = html.find(body_mark)
+        if start == -1:
+            return None
+        gt = html.find(gt_mark, start + len(body_mark))
+        if gt == -1:
+            return None
+        end = html.rfind(body_close_mark, gt + 1)
+        if end == -1:
+            return None
+        return gt + 1, end
+
+    def _text_node_spans(self, html, body_start: int, body_end: int) -> Generator[tuple[int, int], None, None]:
+        """Yield the (start, end) span of the text of each text node of the body, in document order.
+        html can be either str or bytes: the markup characters are ASCII, so they never
+        appear inside a multi-byte UTF-8 sequence.
+        Every character of the body is looked at a bounded number of times, so this is linear
+        in the size of the body whatever the input.
+        """
+        gt_mark, lt_mark, bold_mark = (">", "<", "<b") if isinstance(html, str) else (b">", b"<", b"<b")
+        find = html.find
+        rfind = html.rfind
+
+        gt = find(gt_mark, body_start, body_end)
+        while gt != -1:
+            # text after the end of a tag starting with '<b' (b, br, body, blockquote...) is not bolded.
+            # Only the characters since the previous '>' are searched, and this is checked before
+            # looking for the '<' closing the text node, so runs of '>' are not rescanned.
+            # body_start - 1 is the '>' closing the <body> tag, so the search never leaves the body
+            if find(bold_mark, rfind(gt_mark, body_start - 1, gt) + 1, gt) != -1:
+                gt = find(gt_mark, gt + 1, body_end)
+                continue
+
+            lt = find(lt_mark, gt + 1, body_end)
+            if lt == -1:
+                # a text node must be closed by a tag, there is nothing else to bold
+                return
+
+            yield gt + 1, lt
+
+            # the '<' closing the text node is consumed, the next text node starts after it
+            gt = find(gt_mark, lt + 1, body_end)
+
     def _bold_document(self, html: str, *, remove_metaguiding: bool = False) -> str:
         # get the body. If there is no body, return the original html
-        match = self._body_regex.search(html)
-        if not match:
+        body_span = self._find_body_span(html)
+        if not body_span:
             return html
 
-        body = match.group(1)
+        # the text nodes are found by _text_node_spans and not by a regex with a lookbehind, which
+        # backtracks quadratically on runs of '>' without a closing '<'. The removal substitution is
+        # limited to the body span and returns the whole document, so the body is never copied out
+        # and spliced back with html.replace, which would also replace any other occurrence of the body text
+        body_start, body_end = body_span
         if not remove_metaguiding:
-            # find all text nodes in the body and trigger the bolding of the words
-            body = self._text_block_regex.sub(
-                lambda m: self._bold_text_node(m.group()),
-                body,
-            )
+            # trigger the bolding of the words of each text node, the node includes its '>' and '<'
+            chunks = []
+            copied_up_to = 0  # everything before this offset is already in chunks
+            for start, end in self._text_node_spans(html, body_start, body_end):
+                chunks.append(html[copied_up_to : start - 1])
+                chunks.append(self._bold_text_node(html[start - 1 : end + 1]))
+                copied_up_to = end + 1
+            chunks.append(html[copied_up_to:])
+            html = "".join(chunks)
         else:
-            body = self._bolded_text_block_regex.sub(lambda m: self._unbold_node_text_part(m.group()), body)
-
-        _logger.debug(f"Bolded body: {body}")
+            html = self._bolded_text_block_regex.sub(
+                lambda m: self._unbold_node_text_part(m.group()),
+                html,
+                pos=body_start,
+                endpos=body_end,
+            )
 
-        html = html.replace(match.group(1), body)
+        _logger.debug(f"Bolded body: {body_end - body_start} characters")
         return html
 
-    def _get_encoding_using_lxml(self, xhtml_document: bytes) -> str | None:
-        from lxml import etree
-
-        parser = etree.XMLParser(resolve_entities=False)
-        doc = etree.fromstring(xhtml_document, parser=parser).getroottree()
-        docinfo = doc.docinfo
-        return docinfo.encoding
-
     def _get_encoding_using_bom(self, xhtml_document: bytes) -> str | None:
         if xhtml_document.startswith(b"\xef\xbb\xbf"):
             return "utf-8"
@@ -167,7 +367,7 @@ class RegExBoldMetaguider:
         if not xhtml_document.startswith(b"<?xml "):
             return None
 
-        xml_header_end = xhtml_document.find(b"?>") + 1
+        xml_header_end = xhtml_document.find(b"?>", 0, _ENCODING_SNIFF_SIZE) + 1
         if xml_header_end == 0:
             msg = "Invalid XHTML document. Could not find closing XML element."
             raise ValueError(msg)
@@ -182,38 +382,566 @@ class RegExBoldMetaguider:
             # and we will not raise an exception
             return None
 
-    def _get_encoding(self, xhtml_document: bytes) -> str:
-        encoding = self._get_encoding_using_xml_header(xhtml_document)
-
-        if not encoding:
-            _logger.debug(
-                "Could not detect the encoding of the XHTML document using the XML header. "
-                "Trying to detect the encoding using the BOM."
-            )
-            encoding = self._get_encoding_using_bom(xhtml_document)
+    def _get_encoding_using_appendix_f(self, xhtml_document: bytes) -> str | None:
+        # XML 1.0 Appendix F: without a BOM, the first four bytes of "<?xml" or "<" give the encoding family
+        for prefix, encoding in self._appendix_f_prefixes:
+            if xhtml_document.startswith(prefix):
+                return encoding
+        return None
 
-        if not encoding:
-            _logger.debug(
-                "Could not detect the encoding of the XHTML document. Trying to detect the encoding using lxml."
-            )
-            encoding = self._get_encoding_using_lxml(xhtml_document)
+    def _get_encoding_using_meta(self, xhtml_document: bytes) -> str | None:
+        # <meta charset="..."> or <meta http-equiv="Content-Type" content="...; charset=...">, in the first KB only
+        match = self._meta_charset_regex.search(xhtml_document, 0, _ENCODING_SNIFF_SIZE)
+        if not match:
+            return None
+        encoding = match.group(1).decode("ascii")
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            _logger.debug(f"Ignoring unknown encoding '{encoding}' found in a meta element")
+            return None
+        return encoding
 
-        return encoding or self._fallback_encoding
+    def _get_encoding(self, xhtml_document: bytes) -> str:
+        # all the detectors only look at the first KB of the document, the first one that matches wins
+        for detector, get_encoding in (
+            ("xml_header", self._get_encoding_using_xml_header),
+            ("bom", self._get_encoding_using_bom),
+            ("appendix_f", self._get_encoding_using_appendix_f),
+            ("meta", self._get_encoding_using_meta),
+        ):
+            encoding = get_encoding(xhtml_document)
+            if encoding:
+                self.stats[f"encoding_{detector}"] += 1
+                return encoding
+            _logger.debug(f"Could not detect the encoding of the XHTML document using the {detector} detector.")
+
+        self.stats["encoding_fallback"] += 1
+        return self._fallback_encoding
 
     def metaguide_xhtml_document(self, xhtml_document: bytes, *, remove_metaguiding: bool = False) -> bytes:
         # if none of the methods to detect the encoding work, use utf-8
         encoding = self._get_encoding(xhtml_document) or "utf-8"
+        return self._metaguide_encoded_document(xhtml_document, encoding, remove_metaguiding=remove_metaguiding)
 
+    def _metaguide_encoded_document(
+        self, xhtml_document: bytes, encoding: str, *, remove_metaguiding: bool = False
+    ) -> bytes:
+        self.stats["str_path"] += 1
         html = xhtml_document.decode(encoding)
         bolded_html = self._bold_document(html, remove_metaguiding=remove_metaguiding)
         return bolded_html.encode(encoding)
 
+    def metaguide_xhtml_document_stream(
+        self, input_stream, output_stream, *, remove_metaguiding: bool = False, chunk_size: int = _STREAM_CHUNK_SIZE
+    ) -> None:
+        # the document is read whole, supports_streaming is False
+        output_stream.write(self.metaguide_xhtml_document(input_stream.read(), remove_metaguiding=remove_metaguiding))
+
+
+class TokenizerBoldMetaguider(RegExBoldMetaguider):
+    """Single-pass variant of RegExBoldMetaguider.
+
+    Instead of nesting a text node substitution, an entity split and a word substitution,
+    the body is walked once from left to right: tag boundaries are located with find,
+    and the words of each text node are bolded by a single regex that skips entity references.
+    The output is built with one join. The result is byte-identical to RegExBoldMetaguider.
+
+    UTF-8 and ASCII documents are bolded directly on bytes, without decoding and encoding the
+    whole document: only text nodes containing non-ASCII characters are decoded. Invalid UTF-8
+    outside the text nodes is copied as is instead of raising UnicodeDecodeError.
+
+    Removing the metaguiding is done in one pass over the body, by a regex that only matches the
+    <b> tags this engine writes, splitting a word at its midpoint. The number of removed tags is
+    counted in stats["bold_tags_removed"]. If the body has none, the RegExBoldMetaguider removal
+    is used instead.
+    """
+
+    supports_bytes = True
+    supports_streaming = True
+
+    _text_word_regex = re.compile(r"&[#a-zA-Z][a-zA-Z0-9]*;(*SKIP)(*FAIL)|\w+", re.UNICODE)
+    # \w is ASCII only on bytes, so this must only be used on ASCII text
+    _text_word_bytes_regex = re.compile(rb"&[#a-zA-Z][a-zA-Z0-9]*;(*SKIP)(*FAIL)|\w+")
+    _bytes_encodings = ("utf-8", "ascii")
+    # a word bolded by _bold_word_match: <b>, the first part of the word, </b> and the rest of the word
+    _bolded_word_exact_regex = re.compile(r"(?<!\w)<b>(\w+)</b>(\w*)", re.UNICODE)
+
+    def _bold_word_match(self, match) -> str:
+        # same as _bold_word, but called directly by the regex to save a function call per word.
+        # \w+ never matches whitespace, so there is no need to check for empty words
+        word = match.group()
+        word_length = len(word)
+        midpoint = 1 if word_length in (1, 3) else (word_length + 1) // 2
+        return f"<b>{word[:midpoint]}</b>{word[midpoint:]}"
+
+    def _bold_word_bytes_match(self, match) -> bytes:
+        # bytes version of _bold_word_match
+        word = match.group()
+        word_length = len(word)
+        midpoint = 1 if word_length in (1, 3) else (word_length + 1) // 2
+        return b"<b>" + word[:midpoint] + b"</b>" + word[midpoint:]
+
+    def _bold_cached_word_match(self, match):
+        # the cache lookup is inlined, a method call would cost as much as bolding the word.
+        # str and bytes words share the cache, they never compare equal
+        word = match.group()
+        bolded = self._word_cache.get(word)
+        if bolded is not None:
+            self._word_cache.move_to_end(word)
+            self.stats["word_cache_hits"] += 1
+            return bolded
+
+        self.stats["word_cache_misses"] += 1
+        bolded = self._bold_word_bytes_match(match) if isinstance(word, bytes) else self._bold_word_match(match)
+        self._add_cached_word(word, bolded)
+        return bolded
+
+    def _bold_text(self, text: str) -> str:
+        bold_match = self._bold_cached_word_match if self._word_cache_size > 0 else self._bold_word_match
+        return self._text_word_regex.sub(bold_match, text)
+
+    def _bold_utf8_text(self, text: bytes) -> bytes:
+        if text.isascii():
+            bold_match = self._bold_cached_word_match if self._word_cache_size > 0 else self._bold_word_bytes_match
+            return self._text_word_bytes_regex.sub(bold_match, text)
+        return self._bold_text(text.decode("utf-8")).encode("utf-8")
+
+    def _bold_html(self, html, body_start: int, body_end: int, bold_text: Callable):
+        chunks: list = []
+        append = chunks.append
+        copied_up_to = 0  # everything before this offset is already in chunks
+        for start, end in self._text_node_spans(html, body_start, body_end):
+            append(html[copied_up_to:start])
+            append(bold_text(html[start:end]))
+            copied_up_to = end
+
+        append(html[copied_up_to:])
+        return html[:0].join(chunks)
+
+    def _unbold_word_match(self, match) -> str:
+        # only remove the tags if they split the word exactly where _bold_word_match does
+        prefix, suffix = match.group(1, 2)
+        word_length = len(prefix) + len(suffix)
+        midpoint = 1 if word_length in (1, 3) else (word_length + 1) // 2
+        if len(prefix) != midpoint:
+            return match.group()
+        self.stats["bold_tags_removed"] += 1
+        return prefix + suffix
+
+    def _unbold_html(self, html: str, body_start: int, body_end: int) -> str:
+        removed_before = self.stats["bold_tags_removed"]
+        unbolded_html = self._bolded_word_exact_regex.sub(
+            self._unbold_word_match, html, pos=body_start, endpos=body_end
+        )
+        removed = self.stats["bold_tags_removed"] - removed_before
+        _logger.debug(f"Removed {removed} bold tags")
+        if removed:
+            return unbolded_html
+
+        # nothing looks like our own bolding, the document may have been bolded by another version
+        self.stats["unbold_fallback"] += 1
+        return super()._bold_document(html, remove_metaguiding=True)
+
+    def _bold_document(self, html: str, *, remove_metaguiding: bool = False) -> str:
+        # get the body. If there is no body, return the original html
+        body_span = self._find_body_span(html)
+        if not body_span:
+            return html
+
+        if remove_metaguiding:
+            return self._unbold_html(html, *body_span)
+        return self._bold_html(html, *body_span, self._bold_text)
+
+    def _bold_utf8_document(self, xhtml_document: bytes) -> bytes:
+        body_span = self._find_body_span(xhtml_document)
+        if not body_span:
+            return xhtml_document
+
+        return self._bold_html(xhtml_document, *body_span, self._bold_utf8_text)
+
+    def _metaguide_encoded_document(
+        self, xhtml_document: bytes, encoding: str, *, remove_metaguiding: bool = False
+    ) -> bytes:
+        encoding_name = codecs.lookup(encoding).name
+        # a document declared as ascii but with non-ascii bytes fails on the str path, as before
+        if (
+            not remove_metaguiding
+            and encoding_name in self._bytes_encodings
+            and (encoding_name == "utf-8" or xhtml_document.isascii())
+        ):
+            self.stats["bytes_path"] += 1
+            return self._bold_utf8_document(xhtml_document)
+
+        return super()._metaguide_encoded_document(xhtml_document, encoding, remove_metaguiding=remove_metaguiding)
+
+    def metaguide_xhtml_document_stream(
+        self, input_stream, output_stream, *, remove_metaguiding: bool = False, chunk_size: int = _STREAM_CHUNK_SIZE
+    ) -> None:
+        """Metaguide a xhtml document read in chunks from input_stream, writing the result to output_stream
+        as it is produced, so the memory used depends on the chunk size rather than on the document size.
+        output_stream can be any object with a write method, such as a ZipFile.open(..., "w") handle.
+
+        The output is the same as metaguide_xhtml_document. As a document without a closing </body> tag
+        is left as is, the body is held, spilled to a temporary file when large, until its </body> shows up.
+        Removing the metaguiding is not done incrementally: the document is read whole.
+        """
+        # the first chunk holds everything the encoding detectors look at
+        head = input_stream.read(max(chunk_size, _ENCODING_SNIFF_SIZE))
+        if remove_metaguiding:
+            output_stream.write(
+                self.metaguide_xhtml_document(head + input_stream.read(), remove_metaguiding=remove_metaguiding)
+            )
+            return
+
+        encoding = self._get_encoding(head)
+        if codecs.lookup(encoding).name == "utf-8":
+            self.stats["bytes_path"] += 1
+            bolder = _XhtmlStreamBolder(self._bold_utf8_text, output_stream.write)
+            while head:
+                bolder.feed(head)
+                head = input_stream.read(chunk_size)
+            bolder.close()
+            return
+
+        # other encodings are bolded as UTF-8, where the markup characters are the same ASCII bytes.
+        # surrogatepass keeps any lone surrogate the decoder let through
+        self.stats["str_path"] += 1
+        decoder = codecs.getincrementaldecoder(encoding)()
+        utf8_decoder = codecs.getincrementaldecoder("utf-8")("surrogatepass")
+        encoder = codecs.getincrementalencoder(encoding)()
+
+        def bold_text(text: bytes) -> bytes:
+            return self._bold_text(text.decode("utf-8", "surrogatepass")).encode("utf-8", "surrogatepass")
+
+        def write(data: bytes) -> None:
+            if text := utf8_decoder.decode(data):
+                output_stream.write(encoder.encode(text))
+
+        bolder = _XhtmlStreamBolder(bold_text, write)
+        while head:
+            bolder.feed(decoder.decode(head).encode("utf-8", "surrogatepass"))
+            head = input_stream.read(chunk_size)
+        bolder.feed(decoder.decode(b"", final=True).encode("utf-8", "surrogatepass"))
+        bolder.close()
+        output_stream.write(encoder.encode(utf8_decoder.decode(b"", final=True), final=True))
+
+
+class _XhtmlStreamBolder:
+    """Incremental version of RegExBoldMetaguider._text_node_spans and TokenizerBoldMetaguider._bold_html.
+
+    The body ends at the last </body> and a document without any is not bolded, so the body is held
+    in a temporary file, spilled to disk when large, and only bolded up to a </body> once one shows up.
+    The text node closed by that </body> is bolded if and only if another </body> follows, so it stays
+    held with the rest. When the input ends, the held input is written as is.
+
+    The held input is scanned once, in chunks. Between two chunks, only the scan state is kept: whether
+    it is in a text node or in a tag, and whether a '<b' was seen since the last '>' (the (?<!<b[^>]*)
+    rule). A text node is bolded up to its last whitespace as it is scanned, so only a word split by
+    the chunk boundary waits, and it is read back from the held input.
+    """
+
+    _whitespaces = (b" ", b"\n", b"\t", b"\r")
+
+    def __init__(self, bold_text: Callable[[bytes], bytes], write: Callable[[bytes], object]) -> None:
+        self._bold_text = bold_text
+        self._write_output = write
+        self._carry = b""  # the end of the last chunk, which could be the start of a split <body or </body>
+        self._fed = 0  # the offset in the document of the end of the data fed so far
+        self._in_body_tag = False  # the <body tag is found, but not its '>'
+        self._in_body = False
+        # the input of the body since the last </body> or since the <body> tag, and its bolded output
+        self._held_files = contextlib.ExitStack()
+        self._held_input: BinaryIO = BytesIO()
+        self._held_output: BinaryIO = BytesIO()
+        self._held_output_size = 0
+        self._hold_start = 0  # the offset in the document of the held input
+        self._scanned = 0  # the offset in the document up to which the held input is bolded
+        self._in_text = False
+        self._bold_tag_seen = False  # a '<b' was seen since the last '>'
+        self._text_start = 0  # the offsets of the current text node, in the document and in the held output
+        self._text_output_start = 0
+        self._pending_start = 0  # the offset in the document of the part of the text node not bolded yet
+
+    def feed(self, data: bytes) -> None:
+        if not self._in_body:
+            self._find_body(self._carry + data)
+            return
+
+        self._held_input.write(data)
+        data_start = self._fed - len(self._carry)
+        self._fed += len(data)
+        data, self._carry = self._split_carry(self._carry + data, b"</body>")
+        body_end = data.rfind(b"</body>")
+        if body_end != -1:
+            self._release_held(data_start + body_end)
+
+    def close(self) -> None:
+        if self._in_body:
+            # there is no </body> after the held input, it is written as it was read
+            self._copy_held(self._held_input, 0, None, self._write_output)
+            self._held_files.close()
+        else:
+            self._write_output(self._carry)
+        self._carry = b""
+
+    @staticmethod
+    def _new_held_file() -> BinaryIO:
+        return cast(BinaryIO, tempfile.SpooledTemporaryFile(_STREAM_HOLD_MEMORY_SIZE, "w+b"))
+
+    @staticmethod
+    def _copy_held(held_file: BinaryIO, start: int, end: int | None, write: Callable[[bytes], object]) -> None:
+        # copies held_file[start:end], and leaves the file at its end for the next write
+        remaining = (held_file.seek(0, os.SEEK_END) if end is None else end) - start
+        held_file.seek(start)
+        while remaining > 0:
+            data = held_file.read(min(remaining, _STREAM_CHUNK_SIZE))
+            write(data)
+            remaining -= len(data)
+        held_file.seek(0, os.SEEK_END)
+
+    @staticmethod
+    def _split_carry(data: bytes, mark: bytes) -> tuple[bytes, bytes]:
+        # the longest end of data that is the beginning of mark is carried to the next chunk
+        for length in range(min(len(mark) - 1, len(data)), 0, -1):
+            if data.endswith(mark[:length]):
+                return data[:-length], data[-length:]
+        return data, b""
+
+    def _find_body(self, data: bytes) -> None:
+        if self._in_body_tag:
+            gt = data.find(b">")
+        else:
+            start = data.find(b"<body")
+            if start == -1:
+                data, self._carry = self._split_carry(data, b"<body")
+                self._fed += len(data)
+                self._write_output(data)
+                return
+            self._in_body_tag = True
+            gt = data.find(b">", start + len(b"<body"))
+
+        self._carry = b""
+        if gt == -1:
+            # the rest of the <body> tag, which is never bolded
+            self._fed += len(data)
+            self._write_output(data)
+            return
+
+        self._write_output(data[: gt + 1])
+        self._fed += gt + 1
+        self._hold_start = self._scanned = self._fed
+        self._held_input = self._held_files.enter_context(self._new_held_file())
+        self._held_output = self._held_files.enter_context(self._new_held_file())
+        self._in_body = True
+        self.feed(data[gt + 1 :])
+
+    def _release_held(self, body_end: int) -> None:
+        # a </body> showed up at body_end: the held input is bolded up to it, and written out
+        # except for the text node it closes. The body is held again from there
+        while self._scanned < body_end:
+            self._held_input.seek(self._scanned - self._hold_start)
+            data = self._held_input.read(min(body_end - self._scanned, _STREAM_CHUNK_SIZE))
+            if data.endswith(b"<") and len(data) > 1 and self._scanned + len(data) < body_end:
+                data = data[:-1]  # keeps '<b' in one chunk
+            self._scan(data, self._scanned)
+            self._scanned += len(data)
+
+        if self._in_text:
+            bolded = self._bold_text(self._read_pending(b"", body_end, 0))
+            self._held_output.write(bolded)
+            self._held_output_size += len(bolded)
+            self._in_text = self._bold_tag_seen = False
+            output_end, input_end = self._text_output_start, self._text_start
+        else:
+            output_end, input_end = self._held_output_size, body_end
+
+        self._copy_held(self._held_output, 0, output_end, self._write_output)
+        held_input, held_output, held_files = self._held_input, self._held_output, self._held_files
+        self._held_files = contextlib.ExitStack()
+        with held_files:
+            self._held_input = self._held_files.enter_context(self._new_held_file())
+            self._held_output = self._held_files.enter_context(self._new_held_file())
+            self._copy_held(held_input, input_end - self._hold_start, None, self._held_input.write)
+            self._copy_held(held_output, output_end, None, self._held_output.write)
+        self._held_output_size -= output_end
+        self._hold_start = input_end
+
+    def _scan(self, data: bytes, data_start: int) -> None:
+        # the text nodes of data, at data_start in the document, are bolded into the held output
+        find = data.find
+        end = len(data)
+        chunks: list[bytes] = []
+        output_size = self._held_output_size
+        position = 0
+        while position < end:
+            if self._in_text:
+                lt = find(b"<", position)
+                if lt == -1:
+                    # the text node goes on in the next chunk, it is bolded up to its last whitespace
+                    split = max(data.rfind(whitespace, position) for whitespace in self._whitespaces)
+                    if split != -1:
+                        chunks.append(self._bold_text(self._read_pending(data, data_start, split + 1)))
+                        output_size += len(chunks[-1])
+                        self._pending_start = data_start + split + 1
+                    break
+                chunks.append(self._bold_text(self._read_pending(data, data_start, lt)))
+                output_size += len(chunks[-1])
+                self._in_text = self._bold_tag_seen = False
+                position = lt
+                continue
+
+            gt = find(b">", position)
+            if gt == -1:
+                self._bold_tag_seen = self._bold_tag_seen or find(b"<b", position) != -1
+                chunks.append(data[position:])
+                output_size += end - position
+                break
+
+            chunks.append(data[position : gt + 1])
+            output_size += gt + 1 - position
+            if self._bold_tag_seen or find(b"<b", position, gt) != -1:
+                # the '>' is the end of a tag starting with '<b', see RegExBoldMetaguider._text_node_spans
+                self._bold_tag_seen = False
+            else:
+                self._in_text = True
+                self._text_start = self._pending_start = data_start + gt + 1
+                self._text_output_start = output_size
+            position = gt + 1
+
+        self._held_output.write(b"".join(chunks))
+        self._held_output_size = output_size
+
+    def _read_pending(self, data: bytes, data_start: int, end: int) -> bytes:
+        # the part of the text node not bolded yet, up to data[end]
+        start = self._pending_start - data_start
+        if start >= 0:
+            return data[start:end]
+        # the text node started before data, its beginning is read back from the held input
+        pending: list[bytes] = []
+        self._copy_held(
+            self._held_input, self._pending_start - self._hold_start, data_start - self._hold_start, pending.append
+        )
+        pending.append(data[:end])
+        return b"".join(pending)
+
+
+class LxmlBoldMetaguider(TokenizerBoldMetaguider):
+    """Tree based engine: the document is parsed once with lxml, the words of the text and tail of the
+    nodes inside <body> are bolded by inserting <b> elements, and the tree is serialized back.
+
+    Unlike the regex engines, the text of <script>, <style>, <pre> and <code> is never bolded, and the
+    output is re-serialized by lxml (quoting, entities and empty tags may change). Documents lxml cannot
+    parse (e.g. undeclared html entities) are bolded by TokenizerBoldMetaguider instead.
+    """
+
+    # lxml parses the encoded document, but needs the whole tree
+    supports_bytes = True
+    supports_streaming = False
+
+    _skipped_tags = ("script", "style", "pre", "code")
+    _word_regex = re.compile(r"\w+", re.UNICODE)
+
+    def _bold_into_elements(self, text: str, make_bold_element: Callable) -> tuple[str, list]:
+        # returns the text before the first word, and a <b> element for each word, whose tail is the rest
+        # of the word and the text up to the next word
+        matches = list(self._word_regex.finditer(text))
+        if not matches:
+            return text, []
+
+        elements = []
+        for index, match in enumerate(matches):
+            word = match.group()
+            word_length = len(word)
+            midpoint = 1 if word_length in (1, 3) else (word_length + 1) // 2
+            next_start = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+            element = make_bold_element()
+            element.text = word[:midpoint]
+            element.tail = word[midpoint:] + text[match.end() : next_start]
+            elements.append(element)
+        return text[: matches[0].start()], elements
+
+    def _bold_tree(self, body) -> None:
+        from lxml import etree
+
+        bold_tag = etree.QName(body).namespace and f"{{{etree.QName(body).namespace}}}b" or "b"
+        skipped = set()
+        for element in body.iter(*(f"{{*}}{tag}" for tag in self._skipped_tags)):
+            skipped.update(element.iter())
+
+        # the list is built first, as the tree is changed while bolding. insert() and index() walk the
+        # children, so the <b> elements are added with a slice assignment or next to the node, keeping
+        # a text node with many words linear
+        for node in list(body.iter()):
+            parent = node.getparent()
+            if node.text and isinstance(node.tag, str) and node not in skipped:
+                node.text, elements = self._bold_into_elements(node.text, partial(node.makeelement, bold_tag, {}))
+                node[:0] = elements
+            if node.tail and node is not body and parent not in skipped:
+                node.tail, elements = self._bold_into_elements(node.tail, partial(parent.makeelement, bold_tag, {}))
+                # each element is added right after the node, so they are added in reverse order
+                for element in reversed(elements):
+                    node.addnext(element)
+
+    def _metaguide_encoded_document(
+        self, xhtml_document: bytes, encoding: str, *, remove_metaguiding: bool = False
+    ) -> bytes:
+        if remove_metaguiding:
+            return super()._metaguide_encoded_document(xhtml_document, encoding, remove_metaguiding=True)
+
+        from lxml import etree
+
+        try:
+            parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+            root = etree.fromstring(xhtml_document, parser=parser)
+        except etree.XMLSyntaxError as e:
+            _logger.debug(f"lxml could not parse the document ({e}), using the tokenizer engine")
+            self.stats["lxml_fallback"] += 1
+            return super()._metaguide_encoded_document(xhtml_document, encoding)
+
+        self.stats["lxml_path"] += 1
+        body = next(root.iter("{*}body"), None)
+        if body is None:
+            return xhtml_document
+
+        self._bold_tree(body)
+        has_declaration = xhtml_document.lstrip(b"\xef\xbb\xbf").startswith(b"<?xml")
+        return etree.tostring(root.getroottree(), encoding=encoding, xml_declaration=has_declaration)
+
+    def metaguide_xhtml_document_stream(
+        self, input_stream, output_stream, *, remove_metaguiding: bool = False, chunk_size: int = _STREAM_CHUNK_SIZE
+    ) -> None:
+        # lxml needs the whole tree, so the document is read whole
+        output_stream.write(self.metaguide_xhtml_document(input_stream.read(), remove_metaguiding=remove_metaguiding))
+
+
+class _EpubPackage:
+    """The documents of an epub, from the spine and the manifest of its OPF package document.
+
+    spine_documents: set[str]
+        The zip filenames of the xhtml documents of the spine, i.e. the reading order
+    nav_documents: set[str]
+        The zip filenames of the navigation documents (manifest items with properties="nav")
+    """
+
+    def __init__(self, spine_documents: set[str], nav_documents: set[str]) -> None:
+        self.spine_documents = spine_documents
+        self.nav_documents = nav_documents
+
 
 class _EpubItemFile:
 
-    def __init__(self, filename: str | None = None, content: bytes = b"") -> None:
+    def __init__(
+        self,
+        filename: str | None = None,
+        content: bytes | None = b"",
+        zip_info: zipfile.ZipInfo | None = None,
+        package: _EpubPackage | None = None,
+    ) -> None:
         self.filename = filename
+        # None when the content was not read: the file is copied from zip_info in the input zip
         self.content = content
+        self.zip_info = zip_info
         _extension = (self.filename and os.path.splitext(self.filename)[-1].upper()) or None
 
         # some epub have files with html extension but they are xml files
@@ -221,64 +949,656 @@ class _EpubItemFile:
         # check whether the file is a table of contents or navigation file
         # by checking the filename against a list of known TOC filenames
         # this is a heuristic and may not be 100% accurate.
-        # Separate the directory check from the filename check
-        self.is_toc_document = False
-        if self.filename:
-            # Normalize the filename to lowercase for comparison and remove the directory part
-            filename_base = os.path.basename(self.filename.lower())
-            self.is_toc_document = filename_base in _TOC_FILENAMES
+        self.is_toc_document = self.filename is not None and _is_toc_filename(self.filename)
+        if package is not None:
+            # the package document says which documents are read: only these are metaguided. An epub 2 has no
+            # nav property, so its table of contents in the spine is still found from its filename
+            self.is_xhtml_document = self.filename in package.spine_documents
+            self.is_toc_document = self.is_toc_document or self.filename in package.nav_documents
         self.metaguided = False  # flag to indicate if the file has been metaguided. Useful for multi-threading
+        # the mimetype file must be the first file of the epub, stored uncompressed and without extra field
+        self.is_mimetype = self.filename == _EPUB_MIMETYPE_FILENAME
 
     def __str__(self) -> str:
+        if self.content is None:
+            return f"{self.filename} (not read)"
         return f"{self.filename} ({len(self.content)} bytes)"
 
-    def metaguide(self, metaguider: RegExBoldMetaguider, *, remove_metaguiding: bool = False):
+    @property
+    def is_metaguidable(self) -> bool:
+        # metaguide only changes these files, the other files can be copied as they are
+        return self.is_xhtml_document and not self.is_toc_document
+
+    def metaguide(
+        self, metaguider: MetaguidingEngine, *, remove_metaguiding: bool = False, stats: Counter | None = None
+    ):
         if not remove_metaguiding and self.metaguided:
             _logger.warning(f"File {self.filename} already metaguided, skipping")
         elif self.is_toc_document:
             _logger.debug(f"Skipping nav/toc file {self.filename}")
         elif self.is_xhtml_document:
             _logger.debug(f"Metaguiding file {self.filename}")
-            self.content = metaguider.metaguide_xhtml_document(self.content, remove_metaguiding=remove_metaguiding)
+            original_content = self.content
+            if original_content is None:
+                msg = f"File {self.filename} was not read, it cannot be metaguided"
+                raise ValueError(msg)
+            self.content = metaguider.metaguide_xhtml_document(original_content, remove_metaguiding=remove_metaguiding)
             self.metaguided = True
+            _add_document_stats(stats, original_content, self.content)
             _logger.debug(f"Metaguided file {self.filename}")
         else:
             _logger.debug(f"Skipping file {self.filename}")
 
 
-_metaguider = RegExBoldMetaguider()
+def _get_bold_tag(xhtml_document: bytes) -> bytes:
+    # the <b> tag as it is encoded in the document. UTF-16 and UTF-32 documents start with a BOM or,
+    # without one, with a '<' (XML 1.0 Appendix F). All the other encodings of a xhtml document are ASCII based
+    for prefix, encoding in _WIDE_ENCODING_PREFIXES:
+        if xhtml_document.startswith(prefix):
+            return "<b>".encode(encoding)
+    return b"<b>"
+
+
+def _add_document_stats(stats: Counter | None, original_document: bytes, metaguided_document: bytes) -> None:
+    # the words bolded, or unbolded, are counted from the <b> tags, in a single pass over each document
+    if stats is not None:
+        bold_tag = _get_bold_tag(original_document)
+        stats["chapters"] += 1
+        stats["words"] += abs(metaguided_document.count(bold_tag) - original_document.count(bold_tag))
+
+
+class _BoldTagCountingStream:
+    """Counts the <b> tags read from or written to a binary stream, including the tags split between two
+    chunks, for the stats of the streamed documents."""
+
+    def __init__(self, stream: BinaryIO, bold_tag: bytes) -> None:
+        self._stream = stream
+        self._bold_tag = bold_tag
+        self._tail = b""
+        self.count = 0
+
+    def _count(self, chunk: bytes) -> None:
+        data = self._tail + bytes(chunk)
+        self.count += data.count(self._bold_tag)
+        # the tail is shorter than a whole tag, so no tag is counted twice
+        self._tail = data[1 - len(self._bold_tag) :]
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._stream.read(size)
+        self._count(chunk)
+        return chunk
+
+    def write(self, chunk: bytes) -> int:
+        self._count(chunk)
+        return self._stream.write(chunk)
+
+
+# registry of the engines by name: a factory taking the engine options as keyword arguments
+_METAGUIDING_ENGINES: dict[str, Callable[..., MetaguidingEngine]] = {
+    "regex": RegExBoldMetaguider,
+    "tokenizer": TokenizerBoldMetaguider,
+    "lxml": LxmlBoldMetaguider,
+}
+_metaguider: MetaguidingEngine = TokenizerBoldMetaguider()
+
+
+def register_metaguiding_engine(
+    name: str, engine_factory: Callable[..., MetaguidingEngine], *, replace: bool = False
+) -> None:
+    """Make an engine available by name, to set_metaguiding_engine and to the engine argument of metaguide_*
+    name: str
+        The name of the engine
+    engine_factory: Callable
+        Called with the engine options as keyword arguments, returns a MetaguidingEngine, e.g. the engine class
+    replace: bool
+        If True, replaces an engine already registered with the same name
+    """
+    if name in _METAGUIDING_ENGINES and not replace:
+        msg = f"Metaguiding engine '{name}' is already registered"
+        raise ValueError(msg)
+    _METAGUIDING_ENGINES[name] = engine_factory
 
 
-def _get_epub_item_files_from_zip(input_zip: zipfile.ZipFile) -> list:
-    def read_compressed_file(input_zip: zipfile.ZipFile, filename: str) -> _EpubItemFile:
-        return _EpubItemFile(filename, input_zip.read(filename))
+def get_metaguiding_engines() -> list[str]:
+    """Return the names of the registered engines"""
+    return list(_METAGUIDING_ENGINES)
 
-    epub_item_files = [read_compressed_file(input_zip, f.filename) for f in input_zip.infolist()]
-    _logger.debug(f"Read {len(epub_item_files)} files from input file")
-    return epub_item_files
+
+def create_metaguiding_engine(name: str, **kwargs) -> MetaguidingEngine:
+    """Create a new engine from the registry
+    name: str
+        One of get_metaguiding_engines(), e.g. "regex", "tokenizer" or "lxml"
+    kwargs:
+        Passed to the engine factory, e.g. word_cache_size
+    return: MetaguidingEngine
+        The new engine
+    """
+    if name not in _METAGUIDING_ENGINES:
+        msg = f"Unknown metaguiding engine '{name}', expected one of {list(_METAGUIDING_ENGINES)}"
+        raise ValueError(msg)
+    engine = _METAGUIDING_ENGINES[name](**kwargs)
+    if not isinstance(engine, MetaguidingEngine):
+        msg = f"Metaguiding engine '{name}' does not implement MetaguidingEngine"
+        raise TypeError(msg)
+    return engine
+
+
+def set_metaguiding_engine(name: str, **kwargs) -> MetaguidingEngine:
+    """Choose the engine used by the metaguide_* functions when no engine argument is given
+    name: str
+        One of get_metaguiding_engines(), "tokenizer" is the default
+    kwargs:
+        Passed to the engine factory, e.g. word_cache_size
+    return: MetaguidingEngine
+        The new engine
+    """
+    global _metaguider
+    _metaguider = create_metaguiding_engine(name, **kwargs)
+    return _metaguider
+
+
+def _resolve_engine(engine: MetaguidingEngine | str | None) -> MetaguidingEngine:
+    # the engine argument of the metaguide_* functions: an engine, the name of a registered engine,
+    # or None for the engine chosen by set_metaguiding_engine
+    if engine is None:
+        return _metaguider
+    if isinstance(engine, str):
+        return create_metaguiding_engine(engine)
+    return engine
+
+
+def _is_toc_filename(filename: str) -> bool:
+    # Normalize the filename to lowercase for comparison and remove the directory part
+    return os.path.basename(filename.lower()) in _TOC_FILENAMES
+
+
+def _get_xml_elements_from_zip(input_zip: zipfile.ZipFile, filename: str) -> list[tuple[str, dict[str, str]]]:
+    # the local name and the attributes of each element. The OCF and OPF namespaces changed between epub
+    # versions, so the elements are matched by local name
+    return [
+        (element.tag.rsplit("}", 1)[-1], element.attrib)
+        for element in ElementTree.fromstring(input_zip.read(filename)).iter()
+    ]
+
+
+def _get_epub_package_from_zip(input_zip: zipfile.ZipFile) -> _EpubPackage | None:
+    # parses META-INF/container.xml and the package document it points to. Returns None if the epub has no
+    # readable package document, or if none of its spine documents, other than the nav, is in the zip.
+    # Whatever fails reading them (a missing or encrypted entry, a bad xml or encoding...), the caller
+    # falls back to the file extensions
+    try:
+        rootfile = next(
+            attributes["full-path"]
+            for local_name, attributes in _get_xml_elements_from_zip(input_zip, _EPUB_CONTAINER_FILENAME)
+            if local_name == "rootfile" and attributes.get("full-path")
+        )
+        package_elements = _get_xml_elements_from_zip(input_zip, rootfile)
+    except Exception as e:  # pylint: disable=broad-except
+        _logger.debug(f"Cannot read the package document of the epub: {e!r}")
+        return None
+
+    # the manifest hrefs are urls relative to the package document
+    package_directory = posixpath.dirname(rootfile)
+    manifest = {}
+    nav_documents = set()
+    spine_ids = []
+    for local_name, attributes in package_elements:
+        if local_name == "item" and attributes.get("id") and attributes.get("href"):
+            filename = posixpath.normpath(posixpath.join(package_directory, unquote(attributes["href"])))
+            manifest[attributes["id"]] = (filename, attributes.get("media-type"))
+            if "nav" in attributes.get("properties", "").split():
+                nav_documents.add(filename)
+        elif local_name == "itemref" and attributes.get("idref"):
+            spine_ids.append(attributes["idref"])
+
+    spine_documents = {
+        manifest[idref][0] for idref in spine_ids if idref in manifest and manifest[idref][1] in _XHTML_MEDIA_TYPES
+    }
+    content_documents = {filename for filename in spine_documents - nav_documents if not _is_toc_filename(filename)}
+    if not content_documents & set(input_zip.namelist()):
+        _logger.debug(f"The spine of {rootfile} has no xhtml document in the epub")
+        return None
+    _logger.debug(
+        f"Package document {rootfile}: {len(spine_documents)} spine documents, {len(nav_documents)} nav documents"
+    )
+    return _EpubPackage(spine_documents, nav_documents)
+
+
+def _get_epub_item_files_from_zip(
+    input_zip: zipfile.ZipFile, package: _EpubPackage | None = None
+) -> Generator[_EpubItemFile, None, None]:
+    # the files are read one at a time, when the caller gets to them, so a single file is in memory at once.
+    # Only the files that can be metaguided and the mimetype file are read, the other ones are copied by
+    # _write_item_files_to_zip. The mimetype file comes first, even if it is not first in the input zip.
+    # Without package, the documents to metaguide are guessed from the file extensions
+    for zip_info in sorted(input_zip.infolist(), key=lambda zip_info: zip_info.filename != _EPUB_MIMETYPE_FILENAME):
+        epub_item_file = _EpubItemFile(zip_info.filename, None, zip_info, package)
+        if epub_item_file.is_metaguidable or epub_item_file.is_mimetype:
+            epub_item_file.content = input_zip.read(zip_info)
+        yield epub_item_file
+
+
+def _get_flag_file_from_zip(input_zip: zipfile.ZipFile, *, read_content: bool = True) -> list[_EpubItemFile]:
+    # the flag file is looked up in the central directory, loaded when the zip was opened, and its content
+    # is only read if read_content is True. The list is empty if the epub has no flag file
+    try:
+        zip_info = input_zip.getinfo(_METAGUIDED_FLAG_FILENAME)
+    except KeyError:
+        return []
+    return [_EpubItemFile(zip_info.filename, input_zip.read(zip_info) if read_content else None, zip_info)]
+
+
+def _is_epub_stream_metaguided(input_stream: BinaryIO) -> bool:
+    # only the central directory is read, not the flag file. The stream is left at its start
+    with zipfile.ZipFile(input_stream, "r", allowZip64=True) as input_zip:
+        flag_files = _get_flag_file_from_zip(input_zip, read_content=False)
+        is_metaguided, _ = _check_flag_file(flag_files)
+    input_stream.seek(0)
+    return is_metaguided
 
 
 def _process_epub_item_files(
-    epub_item_files: list[_EpubItemFile], *, remove_metaguiding: bool = False
+    epub_item_files: Iterable[_EpubItemFile],
+    engine: MetaguidingEngine,
+    *,
+    remove_metaguiding: bool = False,
+    stats: Counter | None = None,
 ) -> Generator[_EpubItemFile, None, None]:
     for epub_item_file in epub_item_files:
         _logger.debug(f"Processing file '{epub_item_file.filename}' remove_metaguiding={remove_metaguiding}")
-        epub_item_file.metaguide(_metaguider, remove_metaguiding=remove_metaguiding)
+        epub_item_file.metaguide(engine, remove_metaguiding=remove_metaguiding, stats=stats)
         yield epub_item_file
 
 
-def _write_item_files_to_zip(epub_item_files, output_zip):
-    def write_compressed_file(output_zip: zipfile.ZipFile, epub_item_file: _EpubItemFile):
-        if epub_item_file.filename is None:
-            msg = "EpubItemFile.filename is None"
+# the engine of a worker process of _process_epub_item_files_in_pool or metaguide_dir, sent once when the
+# process starts, so each worker has its own engine instance
+_worker_engine: MetaguidingEngine | None = None
+
+
+def _init_worker_engine(engine: MetaguidingEngine) -> None:
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _get_worker_engine() -> MetaguidingEngine:
+    if _worker_engine is None:
+        msg = "The worker process has no engine"
+        raise RuntimeError(msg)
+    return _worker_engine
+
+
+def _metaguide_documents_in_worker(documents: list[bytes], remove_metaguiding: bool) -> list[bytes]:
+    engine = _get_worker_engine()
+    return [engine.metaguide_xhtml_document(document, remove_metaguiding=remove_metaguiding) for document in documents]
+
+
+def _process_epub_item_files_in_pool(
+    epub_item_files: Iterable[_EpubItemFile],
+    engine: MetaguidingEngine,
+    workers: int,
+    *,
+    remove_metaguiding: bool = False,
+    stats: Counter | None = None,
+) -> Generator[_EpubItemFile, None, None]:
+    """Same as _process_epub_item_files, with the xhtml documents metaguided by a pool of worker processes,
+    as bolding is CPU bound and holds the GIL. The documents are sent in batches of about
+    _PROCESS_POOL_BATCH_SIZE bytes and the files are yielded in their original order. At most 2 batches per
+    worker are in flight, so the memory used stays bounded. The engine is copied to each worker, so its
+    stats and word cache are not updated.
+    """
+    # each pending entry is a batch of files and their documents, with the future of their metaguided content,
+    # or None for the files that are not metaguided in the workers
+    pending: deque[tuple[list[_EpubItemFile], list[bytes], Future | None]] = deque()
+    batch: list[_EpubItemFile] = []
+    batch_documents: list[bytes] = []
+    batch_size = 0
+
+    def pop_ready(max_pending: int) -> Generator[_EpubItemFile, None, None]:
+        while pending and (len(pending) > max_pending or pending[0][2] is None or pending[0][2].done()):
+            batch_files, documents, future = pending.popleft()
+            if future is not None:
+                for epub_item_file, document, content in zip(batch_files, documents, future.result()):
+                    _add_document_stats(stats, document, content)
+                    epub_item_file.content = content
+                    epub_item_file.metaguided = True
+                    _logger.debug(f"Metaguided file {epub_item_file.filename} in a worker process")
+            yield from batch_files
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker_engine, initargs=(engine,)) as executor:
+
+        def submit_batch() -> None:
+            nonlocal batch, batch_documents, batch_size
+            if batch:
+                future = executor.submit(_metaguide_documents_in_worker, batch_documents, remove_metaguiding)
+                pending.append((batch, batch_documents, future))
+                batch, batch_documents, batch_size = [], [], 0
+
+        try:
+            for epub_item_file in epub_item_files:
+                _logger.debug(f"Processing file '{epub_item_file.filename}' remove_metaguiding={remove_metaguiding}")
+                content = epub_item_file.content
+                if epub_item_file.is_metaguidable and not epub_item_file.metaguided and content is not None:
+                    batch.append(epub_item_file)
+                    batch_documents.append(content)
+                    batch_size += len(content)
+                    if batch_size >= _PROCESS_POOL_BATCH_SIZE:
+                        submit_batch()
+                else:
+                    # the files in the current batch come first, to keep the order
+                    submit_batch()
+                    epub_item_file.metaguide(engine, remove_metaguiding=remove_metaguiding, stats=stats)
+                    pending.append(([epub_item_file], [], None))
+                yield from pop_ready(workers * 2)
+            submit_batch()
+            yield from pop_ready(0)
+        finally:
+            for _, _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    # the zip64 sizes of the input entry are written again by ZipInfo.FileHeader and ZipFile.close when needed
+    records = []
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id != _ZIP64_EXTRA_ID:
+            records.append(extra[offset : offset + 4 + size])
+        offset += 4 + size
+    return b"".join(records)
+
+
+def _copy_zip_entry_raw(input_zip: zipfile.ZipFile, zip_info: zipfile.ZipInfo, output_zip: zipfile.ZipFile) -> bool:
+    """Copy an entry from the input zip to the output zip as its compressed bytes, without decompressing
+    and compressing it again. The CRC, sizes, compression and timestamp of the input entry are kept.
+    zipfile has no API for this, so the local header is written from a copy of the ZipInfo, like
+    ZipFile.open does, followed by the compressed bytes.
+
+    Returns:
+        False if the entry cannot be copied as is (encrypted, or an unexpected local header), nothing is written
+    """
+    if zip_info.flag_bits & _ZIP_ENCRYPTED_FLAG:
+        return False
+
+    # the lock of the zip file is private, it is the one ZipFile.open takes to read an entry
+    input_zip_state: Any = input_zip
+    with input_zip_state._lock:
+        input_fp = input_zip.fp
+        if input_fp is None:
+            return False
+        input_fp.seek(zip_info.header_offset)
+        local_header = input_fp.read(_ZIP_LOCAL_HEADER_SIZE)
+        if len(local_header) != _ZIP_LOCAL_HEADER_SIZE or not local_header.startswith(_ZIP_LOCAL_HEADER_SIGNATURE):
+            return False
+        local_header_fields = struct.unpack(_ZIP_LOCAL_HEADER_STRUCT, local_header)
+        # the name and extra field of the local header can differ from the ones of the central directory
+        input_fp.seek(
+            local_header_fields[_ZIP_LOCAL_HEADER_NAME_LENGTH] + local_header_fields[_ZIP_LOCAL_HEADER_EXTRA_LENGTH],
+            os.SEEK_CUR,
+        )
+
+        output_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+        output_info.compress_type = zip_info.compress_type
+        output_info.CRC = zip_info.CRC
+        output_info.compress_size = zip_info.compress_size
+        output_info.file_size = zip_info.file_size
+        output_info.create_system = zip_info.create_system
+        output_info.external_attr = zip_info.external_attr
+        output_info.comment = zip_info.comment
+        output_info.extra = _strip_zip64_extra(zip_info.extra)
+        # the CRC and sizes are known, so they are in the local header instead of a data descriptor
+        output_info.flag_bits = zip_info.flag_bits & ~_ZIP_DATA_DESCRIPTOR_FLAG
+
+        def read_compressed_chunks() -> Generator[bytes, None, None]:
+            remaining = zip_info.compress_size
+            while remaining > 0:
+                chunk = input_fp.read(min(remaining, _STREAM_CHUNK_SIZE))
+                if not chunk:
+                    msg = f"Truncated zip entry {zip_info.filename}"
+                    raise zipfile.BadZipFile(msg)
+                yield chunk
+                remaining -= len(chunk)
+
+        _write_zip_entry_raw(output_zip, output_info, read_compressed_chunks())
+    return True
+
+
+def _write_zip_entry_raw(output_zip: zipfile.ZipFile, output_info: zipfile.ZipInfo, chunks: Iterable[bytes]) -> None:
+    # writes an entry whose compressed bytes, CRC and sizes are already known, without compressing it.
+    # The state of the zip file is private, this is what ZipFile.open does to write an entry
+    output_zip_state: Any = output_zip
+    with output_zip_state._lock:
+        output_fp = output_zip.fp
+        if output_fp is None:
+            msg = "Attempt to write to ZIP archive that was already closed"
             raise ValueError(msg)
+        if output_zip_state._writing:
+            msg = "Can't write to the ZIP file while there is another write handle open on it"
+            raise ValueError(msg)
+        output_zip_state._writecheck(output_info)
+        output_zip_state._didModify = True
+        if output_zip_state._seekable:
+            output_fp.seek(output_zip.start_dir)
+        output_info.header_offset = output_fp.tell()
+        output_fp.write(output_info.FileHeader())
+        for chunk in chunks:
+            output_fp.write(chunk)
+        output_zip.filelist.append(output_info)
+        output_zip.NameToInfo[output_info.filename] = output_info
+        output_zip.start_dir = output_fp.tell()
+
+
+class _EpubCompression:
+    """How the files of the output epub are compressed.
+
+    The metaguided xhtml documents and the flag file use compression and compresslevel. The other files
+    (images, fonts, css, table of contents...) are copied as their compressed bytes, unless other_compression
+    is set, in which case they are compressed again with other_compression and other_compresslevel. The
+    mimetype file is always stored uncompressed. The files that are in memory are compressed by up to
+    threads threads, the other ones are compressed on the calling thread while they are read.
+    """
+
+    def __init__(
+        self,
+        compression: int = zipfile.ZIP_DEFLATED,
+        compresslevel: int | None = None,
+        other_compression: int | None = None,
+        other_compresslevel: int | None = None,
+        threads: int | None = None,
+    ) -> None:
+        for method, level in ((compression, compresslevel), (other_compression, other_compresslevel)):
+            if method is not None and method not in _EPUB_COMPRESSIONS:
+                msg = f"Unsupported compression {method}, an epub can only use ZIP_STORED or ZIP_DEFLATED"
+                raise ValueError(msg)
+            if level is not None and not 0 <= level <= 9:
+                msg = f"Unsupported compression level {level}, expected 0 (fastest) to 9 (smallest)"
+                raise ValueError(msg)
+        if threads is not None and threads < 1:
+            msg = f"Unsupported number of compression threads {threads}, expected at least 1"
+            raise ValueError(msg)
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.other_compression = other_compression
+        self.other_compresslevel = other_compresslevel
+        self.threads = threads or _DEFAULT_COMPRESSION_THREADS
+
+    def get(self, epub_item_file: _EpubItemFile) -> tuple[int, int | None] | None:
+        # the compression method and level of the file, None to copy the compressed bytes of the input file
+        if epub_item_file.is_mimetype:
+            return zipfile.ZIP_STORED, None
+        if epub_item_file.content is None:
+            if self.other_compression is None:
+                return None
+            return self.other_compression, self.other_compresslevel
+        return self.compression, self.compresslevel
+
+
+def _get_output_zip_info(epub_item_file: _EpubItemFile, compress_type: int, compresslevel: int | None):
+    input_info = epub_item_file.zip_info
+    if input_info is not None and not epub_item_file.metaguided:
+        # the content did not change, so the timestamp and attributes of the input file are kept
+        zip_info = zipfile.ZipInfo(input_info.filename, input_info.date_time)
+        zip_info.external_attr = input_info.external_attr
+        zip_info.file_size = input_info.file_size
+    elif epub_item_file.filename is None:
+        msg = "Cannot write a file without a name to the epub"
+        raise ValueError(msg)
+    else:
+        zip_info = zipfile.ZipInfo(epub_item_file.filename, time.localtime(time.time())[:6])
+        zip_info.file_size = len(epub_item_file.content or b"")
+    # file_size is only a hint for ZipFile.open to choose zip64, it is set again once written
+    zip_info.compress_type = compress_type
+    # the compression level of an entry is private, it is what ZipFile.writestr sets from its compresslevel
+    zip_info_state: Any = zip_info
+    zip_info_state._compresslevel = compresslevel
+    return zip_info
+
+
+def _compress_item_file(
+    epub_item_file: _EpubItemFile, compress_type: int, compresslevel: int | None
+) -> tuple[zipfile.ZipInfo, bytes]:
+    # compresses a file that is in memory, like ZipFile.open does, but without the lock of the output zip,
+    # so it can run on any thread. zlib releases the GIL while compressing
+    start = time.perf_counter()
+    content = epub_item_file.content or b""
+    zip_info = _get_output_zip_info(epub_item_file, compress_type, compresslevel)
+    zip_info.file_size = len(content)
+    zip_info.CRC = zlib.crc32(content)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel, zlib.DEFLATED, -15
+        )
+        compressed = compressor.compress(content) + compressor.flush()
+    else:
+        compressed = content
+    zip_info.compress_size = len(compressed)
+    _logger.debug(
+        f"Compressed file {epub_item_file.filename} from {zip_info.file_size} to {zip_info.compress_size} bytes "
+        f"in {(time.perf_counter() - start) * 1000:.2f} ms"
+    )
+    return zip_info, compressed
+
+
+def _write_item_files_to_zip(
+    epub_item_files: Iterable[_EpubItemFile],
+    output_zip: zipfile.ZipFile,
+    input_zip: zipfile.ZipFile | None = None,
+    compression: _EpubCompression | None = None,
+):
+    compression = compression or _EpubCompression()
 
+    def copy_file(output_zip: zipfile.ZipFile, epub_item_file: _EpubItemFile):
+        # the files that were not read are copied from the input zip by the calling thread
         _logger.debug(f"Writing file {epub_item_file.filename} to output zip {output_zip.filename}")
-        with output_zip.open(epub_item_file.filename, mode="w") as compressed_output_file:
-            compressed_output_file.write(epub_item_file.content)
+        if input_zip is None or epub_item_file.zip_info is None:
+            msg = f"EpubItemFile {epub_item_file.filename} was not read and has no input zip to copy from"
+            raise ValueError(msg)
+        compress = compression.get(epub_item_file)
+        if compress is None:
+            # the file was not changed, so its compressed bytes are copied as they are
+            if _copy_zip_entry_raw(input_zip, epub_item_file.zip_info, output_zip):
+                return
+            _logger.debug(f"Cannot copy {epub_item_file.filename} compressed, copying it decompressed")
+            compress = epub_item_file.zip_info.compress_type, None
+            if compress[0] not in _EPUB_COMPRESSIONS:
+                compress = zipfile.ZIP_DEFLATED, None
+
+        # copied in chunks, so large images and audio files are never whole in memory
+        zip_info = _get_output_zip_info(epub_item_file, *compress)
+        with input_zip.open(epub_item_file.zip_info) as compressed_input_file, output_zip.open(
+            zip_info, mode="w"
+        ) as compressed_output_file:
+            shutil.copyfileobj(compressed_input_file, compressed_output_file, _STREAM_CHUNK_SIZE)
+
+    # the files in memory are compressed by the pool while the next files are read and metaguided, and
+    # are written in order. At most 2 files per thread wait to be written, so memory stays bounded.
+    # With a single thread, each file is compressed and written before the next one is read
+    pending: deque[Future | _EpubItemFile] = deque()
+    max_pending = 0 if compression.threads == 1 else compression.threads * 2
+
+    def write_pending(max_pending: int) -> None:
+        while len(pending) > max_pending or (pending and not isinstance(pending[0], Future)):
+            head = pending.popleft()
+            if isinstance(head, Future):
+                zip_info, compressed = head.result()
+                _write_zip_entry_raw(output_zip, zip_info, (compressed,))
+            else:
+                copy_file(output_zip, head)
 
-    for _epub_item_file in epub_item_files:
-        write_compressed_file(output_zip, _epub_item_file)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(compression.threads, thread_name_prefix="metaguiding-compress") as executor:
+        try:
+            # each file is released once written, as epub_item_files is usually a generator
+            for epub_item_file in epub_item_files:
+                if epub_item_file.filename is None:
+                    msg = "EpubItemFile.filename is None"
+                    raise ValueError(msg)
+                # the files not read are copied, or recompressed, from the input zip
+                compress = None if epub_item_file.content is None else compression.get(epub_item_file)
+                if compress is None:
+                    pending.append(epub_item_file)
+                else:
+                    pending.append(executor.submit(_compress_item_file, epub_item_file, *compress))
+                write_pending(max_pending)
+            write_pending(0)
+        finally:
+            for future in pending:
+                if isinstance(future, Future):
+                    future.cancel()
+    _logger.debug(
+        f"Wrote output zip {output_zip.filename} with {compression.threads} compression threads "
+        f"in {(time.perf_counter() - start) * 1000:.2f} ms"
+    )
+
+
+def _fsync_directory(directory: str) -> None:
+    # makes a rename in the directory durable. Directories cannot be opened on Windows, where it is not needed
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+@contextlib.contextmanager
+def _open_output_file(output_file: str, *, durable: bool = False) -> Generator[BinaryIO, None, None]:
+    # the output is written to a temporary file in the same directory, then renamed to output_file once
+    # complete. A partial output is never seen at output_file, and if processing fails the temporary file
+    # is removed instead of being left behind (metaguide_dir skips the files whose output already exists).
+    # If durable is True, the data and the rename are flushed to disk, so after a crash output_file is
+    # either the old or the new file
+    output_dir, output_name = os.path.split(os.path.abspath(output_file))
+    temp_file = os.path.join(output_dir, f".{output_name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        # created by open, so the permissions follow the umask like any other output
+        with open(temp_file, "xb") as output_writer:
+            yield output_writer
+            if durable:
+                output_writer.flush()
+                os.fsync(output_writer.fileno())
+        if os.path.exists(output_file):
+            shutil.copymode(output_file, temp_file)
+        os.replace(temp_file, output_file)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+        raise
+    if durable:
+        _fsync_directory(output_dir)
+
+
+def _get_output_file(input_file: str, output_file: str | None) -> tuple[str, bool]:
+    # returns the file to write and whether the input file is rewritten in place. In place, the real file is
+    # rewritten, so a symbolic link to it is kept
+    if output_file is None or (os.path.isfile(output_file) and os.path.samefile(input_file, output_file)):
+        return os.path.realpath(input_file), True
+    return output_file, False
 
 
 def _ensure_file_exists(input_file: str):
@@ -297,12 +1617,12 @@ def _ensure_allowed_extension(input_file: str, extensions: list[str]):
 
 
 def _check_flag_file(
-    epub_item_files: list[_EpubItemFile], *, remove_metaguiding: bool = False
+    epub_item_files: Iterable[_EpubItemFile], *, remove_metaguiding: bool = False
 ) -> tuple[bool, _EpubItemFile | None]:
     """Check if an epub file is already metaguided by looking for the flag file.
 
     Args:
-        epub_item_files: List of files in the epub
+        epub_item_files: Files in the epub, e.g. from _get_flag_file_from_zip
         remove_metaguiding: Whether we're removing metaguiding
 
     Returns:
@@ -314,137 +1634,853 @@ def _check_flag_file(
     if is_already_metaguided:
         try:
             _logger.debug("Epub already metaguided, flag file content:")
-            if flag_file:
+            if flag_file and flag_file.content is not None:
                 _logger.debug(flag_file.content.decode("utf-8"))
             else:
-                _logger.debug("Flag file found but content could not be read")
+                _logger.debug("Flag file found, its content was not read")
         except Exception as e:
             _logger.debug(f"Could not decode flag file content: {e}")
 
     return is_already_metaguided, flag_file
 
 
-def metaguide_epub_file(input_file: str, output_file: str, *, remove_metaguiding: bool = False):
+def metaguide_epub_file(
+    input_file: str,
+    output_file: str | None = None,
+    *,
+    remove_metaguiding: bool = False,
+    engine: MetaguidingEngine | str | None = None,
+    compression: int = zipfile.ZIP_DEFLATED,
+    compresslevel: int | None = None,
+    other_compression: int | None = None,
+    other_compresslevel: int | None = None,
+    compression_threads: int | None = None,
+    workers: int = 1,
+    stats: Counter | None = None,
+) -> bool:
     """Metaguide an epub file
     input_file: str
         The input epub file
-    output_file: str
-        The output epub file
+    output_file: str | None
+        The output epub file. If None or the input file, the input file is rewritten in place: the output is
+        streamed to a temporary file that atomically replaces the input once complete and flushed to disk
     remove_metaguiding: bool
         If True, removes metaguiding from the epub file
+    engine: MetaguidingEngine | str | None
+        The engine, or the name of a registered engine. None uses the engine chosen by set_metaguiding_engine
+    compression: int
+        zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED, for the metaguided xhtml documents
+    compresslevel: int | None
+        The level of ZIP_DEFLATED, from 0 (fastest) to 9 (smallest). None is the zlib default
+    other_compression: int | None
+        The compression of the other files (images, fonts, css...). None copies them as they are compressed
+        in the input epub, which is the fastest
+    other_compresslevel: int | None
+        The level of other_compression
+    compression_threads: int | None
+        The number of threads compressing the files of the output epub. None uses up to 8, depending on the
+        number of cpus. 1 compresses them on the calling thread
+    workers: int
+        The number of processes metaguiding the xhtml documents. 1, the default, metaguides them in the calling
+        process, as do epubs with less than 4 MB of documents. The engine must be picklable, and the worker
+        processes must be able to import this module (not the case of the calibre plugins)
+    stats: Counter | None
+        If given, the number of xhtml documents metaguided is added to stats["chapters"], and the number of
+        words bolded (or unbolded) to stats["words"]
+    return: bool
+        False if the epub is already metaguided and nothing was done: the output is a copy of the input,
+        or is not written at all when it is the input file
     """
 
     _logger.debug(f"Processing file '{input_file}' to output '{output_file}'")
     _ensure_file_exists(input_file)
     _ensure_allowed_extension(input_file, _EPUB_EXTENSIONS)
-
-    with open(input_file, "rb") as input_reader:
-        input_file_stream = BytesIO(input_reader.read())
-        output_file_stream = metaguide_epub_stream(input_file_stream, remove_metaguiding=remove_metaguiding)
-        with open(output_file, "wb") as output_writer:
-            output_writer.write(output_file_stream.read())
-
-
-def metaguide_epub_stream(input_stream: BytesIO, *, remove_metaguiding: bool = False) -> BytesIO:
+    output_file, in_place = _get_output_file(input_file, output_file)
+    epub_compression = _EpubCompression(
+        compression, compresslevel, other_compression, other_compresslevel, compression_threads
+    )
+    if workers < 1:
+        msg = f"Unsupported number of workers {workers}, expected at least 1"
+        raise ValueError(msg)
+
+    if not remove_metaguiding:
+        with open(input_file, "rb") as input_reader:
+            is_already_metaguided = _is_epub_stream_metaguided(input_reader)
+        if is_already_metaguided:
+            if in_place:
+                _logger.info(f"'{input_file}' is already metaguided, leaving it unchanged")
+            else:
+                _logger.info(f"'{input_file}' is already metaguided, copying it unchanged to '{output_file}'")
+                with open(input_file, "rb") as input_reader, _open_output_file(output_file) as output_writer:
+                    shutil.copyfileobj(input_reader, output_writer, _STREAM_CHUNK_SIZE)
+            return False
+
+    # the zip entries are read from the open input file and written to a temporary output file one at a time,
+    # so neither the input nor the output is ever whole in memory. The input is closed before the temporary
+    # file replaces the output, which may be the input file
+    with _open_output_file(output_file, durable=in_place) as output_writer, open(input_file, "rb") as input_reader:
+        _metaguide_epub(
+            input_reader,
+            output_writer,
+            _resolve_engine(engine),
+            remove_metaguiding=remove_metaguiding,
+            compression=epub_compression,
+            workers=workers,
+            stats=stats,
+        )
+    return True
+
+
+def metaguide_epub_stream(
+    input_stream: BytesIO,
+    *,
+    remove_metaguiding: bool = False,
+    engine: MetaguidingEngine | str | None = None,
+    compression: int = zipfile.ZIP_DEFLATED,
+    compresslevel: int | None = None,
+    other_compression: int | None = None,
+    other_compresslevel: int | None = None,
+    compression_threads: int | None = None,
+    workers: int = 1,
+    stats: Counter | None = None,
+) -> BytesIO:
     """Metaguide an epub input stream
     input_file_stream: BytesIO
         The input epub file stream
     remove_metaguiding: bool
         If True, removes metaguiding from the epub file
+    engine: MetaguidingEngine | str | None
+        The engine, or the name of a registered engine. None uses the engine chosen by set_metaguiding_engine
+    compression: int
+        zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED, for the metaguided xhtml documents
+    compresslevel: int | None
+        The level of ZIP_DEFLATED, from 0 (fastest) to 9 (smallest). None is the zlib default
+    other_compression: int | None
+        The compression of the other files (images, fonts, css...). None copies them as they are compressed
+        in the input epub, which is the fastest
+    other_compresslevel: int | None
+        The level of other_compression
+    compression_threads: int | None
+        The number of threads compressing the files of the output epub. None uses up to 8, depending on the
+        number of cpus. 1 compresses them on the calling thread
+    workers: int
+        The number of processes metaguiding the xhtml documents. 1, the default, metaguides them in the calling
+        process, as do epubs with less than 4 MB of documents. The engine must be picklable, and the worker
+        processes must be able to import this module (not the case of the calibre plugins)
+    stats: Counter | None
+        If given, the number of xhtml documents metaguided is added to stats["chapters"], and the number of
+        words bolded (or unbolded) to stats["words"]
     return: BytesIO
-        The metaguided epub file stream
+        The metaguided epub file stream. If the epub is already metaguided, nothing is done and
+        input_stream itself is returned, at its start
     """
+    epub_compression = _EpubCompression(
+        compression, compresslevel, other_compression, other_compresslevel, compression_threads
+    )
+    if workers < 1:
+        msg = f"Unsupported number of workers {workers}, expected at least 1"
+        raise ValueError(msg)
+    if not remove_metaguiding and _is_epub_stream_metaguided(input_stream):
+        _logger.info("Epub already metaguided, returning it unchanged")
+        return input_stream
+
     output_stream = BytesIO()
+    _metaguide_epub(
+        input_stream,
+        output_stream,
+        _resolve_engine(engine),
+        remove_metaguiding=remove_metaguiding,
+        compression=epub_compression,
+        workers=workers,
+        stats=stats,
+    )
+    output_stream.seek(0)
+    return output_stream
+
 
+def _metaguide_epub(
+    input_stream: BinaryIO,
+    output_stream: BinaryIO,
+    engine: MetaguidingEngine,
+    *,
+    remove_metaguiding: bool = False,
+    compression: _EpubCompression | None = None,
+    workers: int = 1,
+    stats: Counter | None = None,
+) -> None:
+    # a pipeline of generators: each zip entry is read, metaguided if it is a xhtml document, written and
+    # released before the next one is read, so the memory used is bounded by the largest xhtml document.
+    # Already metaguided epubs are returned as they are by the callers, see _is_epub_stream_metaguided
     if remove_metaguiding:
         _logger.debug("Removing metaguiding from epub")
     else:
         _logger.debug("Metaguiding epub")
 
-    _logger.debug("Getting item files")
     with zipfile.ZipFile(input_stream, "r", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as input_zip:
         with zipfile.ZipFile(output_stream, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as output_zip:
             _logger.debug("Processing zip: Getting item files")
-            epub_item_files = _get_epub_item_files_from_zip(input_zip)
-
-            # Check if the file is already metaguided
-            is_already_metaguided, _ = _check_flag_file(epub_item_files, remove_metaguiding=remove_metaguiding)
-
-            if is_already_metaguided:
-                _logger.debug("Copying files while preserving structure...")
-                # Even for already metaguided files, we need to properly process through zip mechanisms
-                for item in input_zip.filelist:
-                    with input_zip.open(item.filename) as source, output_zip.open(item.filename, "w") as target:
-                        _logger.debug(f"Copying file {item.filename} with original compression")
-                        target.write(source.read())
+            # the bolding of any document is removed, including the ones an older version bolded from their
+            # file extension. Otherwise only the documents of the spine are metaguided
+            package = None if remove_metaguiding else _get_epub_package_from_zip(input_zip)
+            # the size of the documents is known from the central directory, before any of them is read
+            documents_size = sum(
+                zip_info.file_size
+                for zip_info in input_zip.infolist()
+                if _EpubItemFile(zip_info.filename, None, zip_info, package).is_metaguidable
+            )
+            epub_item_files: Iterable[_EpubItemFile]
+            if workers > 1 and documents_size >= _PROCESS_POOL_MIN_SIZE:
+                _logger.debug(f"Processing zip: Metaguiding {documents_size} bytes of documents in {workers} processes")
+                epub_item_files = _process_epub_item_files_in_pool(
+                    _get_epub_item_files_from_zip(input_zip, package),
+                    engine,
+                    workers,
+                    remove_metaguiding=remove_metaguiding,
+                    stats=stats,
+                )
             else:
-                processed_item_files = list(
-                    _process_epub_item_files(epub_item_files, remove_metaguiding=remove_metaguiding)
+                epub_item_files = _process_epub_item_files(
+                    _get_epub_item_files_from_zip(input_zip, package),
+                    engine,
+                    remove_metaguiding=remove_metaguiding,
+                    stats=stats,
                 )
 
-                if remove_metaguiding:
-                    # remove the metaguided flag file
-                    filtered_files = filter(lambda f: f.filename != _METAGUIDED_FLAG_FILENAME, processed_item_files)
-                    processed_item_files = list(filtered_files)
-                else:
-                    _logger.debug("Processing zip: Adding metaguided flag file")
-                    flag_content = _generate_flag_file_content()
-                    processed_item_files.append(_EpubItemFile(_METAGUIDED_FLAG_FILENAME, flag_content))
-
-                _logger.debug("Processing zip: Writing output zip")
-                _write_item_files_to_zip(processed_item_files, output_zip)
+            if remove_metaguiding:
+                # remove the metaguided flag file
+                epub_item_files = filter(lambda f: f.filename != _METAGUIDED_FLAG_FILENAME, epub_item_files)
+            else:
+                _logger.debug("Processing zip: Adding metaguided flag file")
+                flag_content = _generate_flag_file_content()
+                epub_item_files = itertools.chain(
+                    epub_item_files, [_EpubItemFile(_METAGUIDED_FLAG_FILENAME, flag_content)]
+                )
 
-    output_stream.seek(0)
-    return output_stream
+            _logger.debug("Processing zip: Writing output zip")
+            _write_item_files_to_zip(epub_item_files, output_zip, input_zip, compression)
 
 
-def metaguide_xhtml_file(input_file: str, output_file: str, *, remove_metaguiding: bool = False):
+def metaguide_xhtml_file(
+    input_file: str,
+    output_file: str | None = None,
+    *,
+    remove_metaguiding: bool = False,
+    engine: MetaguidingEngine | str | None = None,
+    stats: Counter | None = None,
+):
     """Metaguide an xhtml file
     input_file: str
         The input xhtml file
-    output_file: str
-        The output xhtml file
+    output_file: str | None
+        The output xhtml file. If None or the input file, the input file is rewritten in place: the output is
+        streamed to a temporary file that atomically replaces the input once complete and flushed to disk
     remove_metaguiding: bool
         If True, removes metaguiding from the xhtml file
+    engine: MetaguidingEngine | str | None
+        The engine, or the name of a registered engine. None uses the engine chosen by set_metaguiding_engine
+    stats: Counter | None
+        If given, 1 is added to stats["chapters"], and the number of words bolded (or unbolded) to
+        stats["words"]
     """
     _logger.debug(f"Processing file '{input_file}' to output '{output_file}'")
     _ensure_file_exists(input_file)
     _ensure_allowed_extension(input_file, _XHTML_EXTENSIONS)
-
-    with open(input_file, "rb") as input_reader:
-        input_file_stream = BytesIO(input_reader.read())
-        output_file_stream = metaguide_xhtml_stream(input_file_stream, remove_metaguiding=remove_metaguiding)
-    output_file_stream.seek(0)
-    with open(output_file, "wb") as output_writer:
-        output_writer.write(output_file_stream.read())
-
-
-def metaguide_xhtml_stream(input_file_stream: BytesIO, *, remove_metaguiding: bool = False) -> BytesIO:
+    engine = _resolve_engine(engine)
+    output_file, in_place = _get_output_file(input_file, output_file)
+
+    # stream the document, so the memory used does not depend on its size when the engine supports it.
+    # The input is closed before the temporary file replaces the output, which may be the input file
+    with _open_output_file(output_file, durable=in_place) as output_writer, open(input_file, "rb") as input_reader:
+        if stats is None:
+            engine.metaguide_xhtml_document_stream(input_reader, output_writer, remove_metaguiding=remove_metaguiding)
+            return
+        bold_tag = _get_bold_tag(input_reader.read(4))
+        input_reader.seek(0)
+        counting_reader = _BoldTagCountingStream(input_reader, bold_tag)
+        counting_writer = _BoldTagCountingStream(output_writer, bold_tag)
+        # the engines only read from and write to the streams, which is all the counting streams do
+        engine.metaguide_xhtml_document_stream(
+            cast(BinaryIO, counting_reader), cast(BinaryIO, counting_writer), remove_metaguiding=remove_metaguiding
+        )
+        stats["chapters"] += 1
+        stats["words"] += abs(counting_writer.count - counting_reader.count)
+
+
+def metaguide_xhtml_stream(
+    input_file_stream: BytesIO,
+    *,
+    remove_metaguiding: bool = False,
+    engine: MetaguidingEngine | str | None = None,
+    stats: Counter | None = None,
+) -> BytesIO:
     """Metaguide an xhtml input stream
     input_file_stream: BytesIO
         The input xhtml file stream
     remove_metaguiding: bool
         If True, removes metaguiding from the xhtml file
+    engine: MetaguidingEngine | str | None
+        The engine, or the name of a registered engine. None uses the engine chosen by set_metaguiding_engine
+    stats: Counter | None
+        If given, 1 is added to stats["chapters"], and the number of words bolded (or unbolded) to
+        stats["words"]
     return: BytesIO
         The metaguided xhtml file stream
     """
     output_file_stream = BytesIO()
-    output_file_stream.write(
-        _metaguider.metaguide_xhtml_document(input_file_stream.read(), remove_metaguiding=remove_metaguiding)
+    document = input_file_stream.read()
+    metaguided_document = _resolve_engine(engine).metaguide_xhtml_document(
+        document, remove_metaguiding=remove_metaguiding
     )
+    _add_document_stats(stats, document, metaguided_document)
+    output_file_stream.write(metaguided_document)
     output_file_stream.seek(0)
     return output_file_stream
 
 
-def metaguide_dir(input_dir: str, output_dir: str, *, remove_metaguiding: bool = False):
-    """Metaguides all epubs and xhtml found in a directory (recursively)
+def _hash_file(filename: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as input_reader:
+        for chunk in iter(partial(input_reader.read, _STREAM_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _get_engine_id(engine: MetaguidingEngine, *, remove_metaguiding: bool) -> str:
+    # the outputs of a previous run are reused only if they were made the same way
+    action = "remove" if remove_metaguiding else "metaguide"
+    return f"{type(engine).__qualname__} {cli_version} {action}"
+
+
+class _DirManifest:
+    """What metaguide_dir made in an output directory, so a rerun only processes the inputs that changed.
+
+    The manifest is a JSON-lines file in the output directory, with a record per input file: its path
+    relative to the input directory, size, mtime and sha256, the engine and version that processed it, and
+    the size, mtime and sha256 of its output. A record is appended as soon as a file is done, so an
+    interrupted run keeps what it did, and the file is compacted to one line per input at the end.
+    """
+
+    def __init__(self, output_dir: str) -> None:
+        self.filename = os.path.join(output_dir, _DIR_MANIFEST_FILENAME)
+        self.records: dict[str, dict] = {}
+        self._appended = 0
+        if os.path.isfile(self.filename):
+            with open(self.filename, encoding="utf-8") as manifest_reader:
+                for line_number, line in enumerate(manifest_reader, 1):
+                    try:
+                        record = json.loads(line)
+                        self.records[record["input"]] = record
+                    except (ValueError, TypeError, KeyError):
+                        _logger.warning(f"Ignoring line {line_number} of {self.filename}, it is not a manifest record")
+            _logger.debug(f"Loaded {len(self.records)} records from {self.filename}")
+
+    def is_up_to_date(self, input_key: str, input_filename: str, output_filename: str, engine_id: str) -> bool | None:
+        """Whether the output of input_filename was made from the same input, by the same engine.
+
+        Returns:
+            None if the input is not in the manifest, otherwise True if it can be skipped, False if it
+            must be processed again
+        """
+        record = self.records.get(input_key)
+        if record is None:
+            return None
+        try:
+            input_stat = os.stat(input_filename)
+            output_stat = os.stat(output_filename)
+        except OSError:
+            return False
+        if (
+            record.get("engine") != engine_id
+            or record.get("output_size") != output_stat.st_size
+            or record.get("output_mtime_ns") != output_stat.st_mtime_ns
+            or record.get("size") != input_stat.st_size
+        ):
+            return False
+        if record.get("mtime_ns") == input_stat.st_mtime_ns:
+            return True
+        # the file was touched or copied: only its content tells whether it changed
+        if record.get("sha256") != _hash_file(input_filename):
+            return False
+        self.add({**record, "mtime_ns": input_stat.st_mtime_ns})
+        return True
+
+    def add(self, record: dict) -> None:
+        self.records[record["input"]] = record
+        with open(self.filename, "a", encoding="utf-8") as manifest_writer:
+            manifest_writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._appended += 1
+
+    def compact(self) -> None:
+        # the records appended during the run replace the older lines of the same inputs
+        if self._appended == 0:
+            return
+        with _open_output_file(self.filename) as manifest_writer:
+            for record in self.records.values():
+                manifest_writer.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self._appended = 0
+
+
+def _get_peak_rss() -> int | None:
+    # the peak resident memory of the process so far, in bytes. None where the resource module is missing
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def _get_cpu_time() -> float:
+    # the CPU time of the process and of its children that ended, such as the workers of a process pool once
+    # it is shut down. The children are not counted on Windows
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _get_dir_file_report(
+    input_filename: str,
+    output_filename: str,
+    input_bytes: int,
+    stats: Counter,
+    wall_time: float,
+    process_cpu_time: float,
+) -> dict:
+    return {
+        "input": input_filename,
+        "output": output_filename,
+        "status": "processed",
+        "wall_time": wall_time,
+        "process_cpu_time": process_cpu_time,
+        "input_bytes": input_bytes,
+        "output_bytes": os.path.getsize(output_filename),
+        "chapters": stats["chapters"],
+        "words": stats["words"],
+        "process_peak_rss": _get_peak_rss(),
+    }
+
+
+def _metaguide_dir_file(
+    input_filename: str,
+    output_filename: str,
+    engine: MetaguidingEngine,
+    *,
+    remove_metaguiding: bool = False,
+    input_key: str | None = None,
+    use_manifest: bool = True,
+) -> tuple[dict | None, dict]:
+    # the files are streamed from the input to the output, and a failed output is removed.
+    # Returns the manifest record (None without manifest, the files are not hashed) and the report of the file.
+    # The input is looked at before it is processed, so a change made while it is processed is seen by the next run
+    start, cpu_start = time.perf_counter(), time.process_time()
+    stats: Counter = Counter()
+    input_stat = os.stat(input_filename)
+    input_hash = _hash_file(input_filename) if use_manifest else None
+    if os.path.splitext(input_filename)[-1].upper() in _EPUB_EXTENSIONS:
+        metaguide_epub_file(
+            input_filename, output_filename, remove_metaguiding=remove_metaguiding, engine=engine, stats=stats
+        )
+    else:
+        metaguide_xhtml_file(
+            input_filename, output_filename, remove_metaguiding=remove_metaguiding, engine=engine, stats=stats
+        )
+    record = None
+    if input_hash is not None:
+        record = _get_dir_manifest_record(
+            input_key or input_filename,
+            input_stat,
+            input_hash,
+            _get_engine_id(engine, remove_metaguiding=remove_metaguiding),
+            output_filename,
+            _hash_file(output_filename),
+        )
+    file_report = _get_dir_file_report(
+        input_filename,
+        output_filename,
+        input_stat.st_size,
+        stats,
+        time.perf_counter() - start,
+        time.process_time() - cpu_start,
+    )
+    return record, file_report
+
+
+def _get_dir_manifest_record(
+    input_key: str,
+    input_stat: os.stat_result,
+    input_hash: str,
+    engine_id: str,
+    output_filename: str,
+    output_hash: str,
+) -> dict:
+    output_stat = os.stat(output_filename)
+    return {
+        "input": input_key,
+        "size": input_stat.st_size,
+        "mtime_ns": input_stat.st_mtime_ns,
+        "sha256": input_hash,
+        "engine": engine_id,
+        "output": os.path.basename(output_filename),
+        "output_size": output_stat.st_size,
+        "output_mtime_ns": output_stat.st_mtime_ns,
+        "output_sha256": output_hash,
+    }
+
+
+def _metaguide_dir_file_in_worker(
+    input_filename: str, output_filename: str, remove_metaguiding: bool, input_key: str, use_manifest: bool
+) -> tuple[dict | None, dict]:
+    return _metaguide_dir_file(
+        input_filename,
+        output_filename,
+        _get_worker_engine(),
+        remove_metaguiding=remove_metaguiding,
+        input_key=input_key,
+        use_manifest=use_manifest,
+    )
+
+
+def _estimate_dir_file_work(input_filename: str, *, remove_metaguiding: bool = False) -> tuple[int, str | None]:
+    # the bytes of documents the file will metaguide, from the zip central directory and the package document,
+    # without reading the documents, and the name of its largest document (None for a xhtml file)
+    try:
+        if os.path.splitext(input_filename)[-1].upper() not in _EPUB_EXTENSIONS:
+            return os.path.getsize(input_filename), None
+        with zipfile.ZipFile(input_filename) as input_zip:
+            if not remove_metaguiding and _get_flag_file_from_zip(input_zip, read_content=False):
+                # already metaguided, it is copied
+                return 0, None
+            package = None if remove_metaguiding else _get_epub_package_from_zip(input_zip)
+            documents = [
+                zip_info
+                for zip_info in input_zip.infolist()
+                if _EpubItemFile(zip_info.filename, None, zip_info, package).is_metaguidable
+            ]
+    except Exception as e:  # pylint: disable=broad-except
+        # the error is reported when the file is processed
+        _logger.debug(f"Cannot estimate the work of {input_filename}: {e!r}")
+        return 0, None
+    if not documents:
+        return 0, None
+    return sum(zip_info.file_size for zip_info in documents), max(documents, key=lambda z: z.file_size).filename
+
+
+def _estimate_engine_throughput(
+    engine: MetaguidingEngine, input_filename: str, document_name: str | None, *, remove_metaguiding: bool = False
+) -> float:
+    # bytes per second of the engine, timed on the start of a document of the library, so the estimate costs
+    # the same whatever the size of the document
+    if document_name is None:
+        with open(input_filename, "rb") as input_reader:
+            document = input_reader.read(_THROUGHPUT_SAMPLE_SIZE)
+    else:
+        with zipfile.ZipFile(input_filename) as input_zip, input_zip.open(document_name) as document_reader:
+            document = document_reader.read(_THROUGHPUT_SAMPLE_SIZE)
+    if len(document) == _THROUGHPUT_SAMPLE_SIZE:
+        # a document without </body> is left as is, so the sample ends after its last tag with a closed body
+        document = document[: document.rfind(b">") + 1] + b"</body></html>"
+    start = time.perf_counter()
+    engine.metaguide_xhtml_document(document, remove_metaguiding=remove_metaguiding)
+    return len(document) / max(time.perf_counter() - start, 1e-6)
+
+
+def _schedule_dir_tasks(
+    tasks: Iterable[tuple[str, str, str]],
+    engine: MetaguidingEngine,
+    *,
+    jobs: int = 1,
+    remove_metaguiding: bool = False,
+) -> list[tuple[str, str, str]]:
+    """Estimate the work of each task of metaguide_dir and order them largest first, so the longest files
+    are not started last, keeping the other workers idle until they end. The estimated runtime is logged.
+    """
+    work = {}
+    largest_document = None
+    for task in tasks:
+        work[task], document_name = _estimate_dir_file_work(task[0], remove_metaguiding=remove_metaguiding)
+        if work[task] and (largest_document is None or work[task] > work[largest_document[0]]):
+            largest_document = task, document_name
+    scheduled = sorted(work, key=work.__getitem__, reverse=True)
+
+    total_work = sum(work.values())
+    if largest_document is not None:
+        (input_filename, _, _), document_name = largest_document
+        try:
+            throughput = _estimate_engine_throughput(
+                engine, input_filename, document_name, remove_metaguiding=remove_metaguiding
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            # the error is reported when the file is processed
+            _logger.debug(f"Cannot time the engine on {input_filename}: {e!r}")
+            return scheduled
+        # a largest-first schedule takes at least the largest file, and at least the total shared by the jobs
+        estimated_seconds = max(total_work / jobs, work[scheduled[0]]) / throughput
+        _logger.info(
+            f"Estimated work: {len(scheduled)} files, {total_work / 1024 / 1024:.2f} MB of documents, "
+            f"largest {work[scheduled[0]] / 1024 / 1024:.2f} MB. At {throughput / 1024 / 1024:.2f} MB/s per job, "
+            f"about {estimated_seconds:.1f} s with {jobs} jobs"
+        )
+    return scheduled
+
+
+def _metaguide_dir_data(
+    input_filename: str,
+    data: bytes,
+    engine: MetaguidingEngine | None,
+    remove_metaguiding: bool,
+    use_manifest: bool,
+) -> tuple[bytes, str | None, Counter, float, int | None]:
+    # the CPU stage of the metaguide_dir pipeline: returns the output, the sha256 of the input (None without
+    # manifest), the stats, the CPU time and the peak RSS of the process. Without engine, it runs in a worker
+    # process and uses the engine of the process
+    cpu_start = time.process_time()
+    engine = engine or _get_worker_engine()
+    stats: Counter = Counter()
+    input_hash = hashlib.sha256(data).hexdigest() if use_manifest else None
+    if os.path.splitext(input_filename)[-1].upper() in _EPUB_EXTENSIONS:
+        output_stream = metaguide_epub_stream(
+            BytesIO(data), remove_metaguiding=remove_metaguiding, engine=engine, stats=stats
+        )
+    else:
+        output_stream = metaguide_xhtml_stream(
+            BytesIO(data), remove_metaguiding=remove_metaguiding, engine=engine, stats=stats
+        )
+    return output_stream.getvalue(), input_hash, stats, time.process_time() - cpu_start, _get_peak_rss()
+
+
+def _read_dir_file(input_filename: str) -> tuple[os.stat_result, bytes]:
+    with open(input_filename, "rb") as input_reader:
+        return os.fstat(input_reader.fileno()), input_reader.read()
+
+
+def _write_dir_file(output_filename: str, data: bytes, *, use_manifest: bool = True) -> str | None:
+    with _open_output_file(output_filename) as output_writer:
+        output_writer.write(data)
+    return hashlib.sha256(data).hexdigest() if use_manifest else None
+
+
+async def _metaguide_dir_pipeline(
+    tasks: Iterable[tuple[str, str, str]],
+    engine: MetaguidingEngine,
+    record_result: Callable[..., None],
+    *,
+    jobs: int = 1,
+    remove_metaguiding: bool = False,
+    use_manifest: bool = True,
+) -> None:
+    """Process the (input_filename, output_filename, input_key) tasks of metaguide_dir in stages that overlap:
+    the files are read by threads, metaguided by jobs worker processes (or a thread if jobs is 1)
+    and written by threads. The stages are linked by queues of _PIPELINE_QUEUE_SIZE files, so at most a few
+    files per stage are in memory, whole.
+    """
+    loop = asyncio.get_running_loop()
+    engine_id = _get_engine_id(engine, remove_metaguiding=remove_metaguiding)
+    task_queue: asyncio.Queue = asyncio.Queue(_PIPELINE_QUEUE_SIZE)
+    read_queue: asyncio.Queue = asyncio.Queue(_PIPELINE_QUEUE_SIZE)
+    write_queue: asyncio.Queue = asyncio.Queue(_PIPELINE_QUEUE_SIZE)
+
+    async def find_files() -> None:
+        for task in tasks:
+            await task_queue.put(task)
+
+    async def read_files() -> None:
+        while (task := await task_queue.get()) is not None:
+            start = time.perf_counter()
+            try:
+                input_stat, data = await asyncio.to_thread(_read_dir_file, task[0])
+            except Exception as e:  # pylint: disable=broad-except
+                record_result(task[0], e)
+                continue
+            await read_queue.put((task, input_stat, data, time.perf_counter() - start))
+
+    async def metaguide_files(executor: ThreadPoolExecutor | ProcessPoolExecutor, stage_engine) -> None:
+        while (item := await read_queue.get()) is not None:
+            task, input_stat, data, wall_time = item
+            start = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(
+                    executor, _metaguide_dir_data, task[0], data, stage_engine, remove_metaguiding, use_manifest
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                record_result(task[0], e)
+                continue
+            await write_queue.put((task, input_stat, wall_time + time.perf_counter() - start, *result))
+
+    async def write_files() -> None:
+        while (item := await write_queue.get()) is not None:
+            task, input_stat, wall_time, output, input_hash, stats, cpu_time, peak_rss = item
+            input_filename, output_filename, input_key = task
+            start = time.perf_counter()
+            try:
+                output_hash = await asyncio.to_thread(
+                    _write_dir_file, output_filename, output, use_manifest=use_manifest
+                )
+                record = None
+                if input_hash is not None and output_hash is not None:
+                    record = _get_dir_manifest_record(
+                        input_key, input_stat, input_hash, engine_id, output_filename, output_hash
+                    )
+                # the time of a file is the sum of its stages, without the time it waited in the queues
+                file_report = _get_dir_file_report(
+                    input_filename,
+                    output_filename,
+                    input_stat.st_size,
+                    stats,
+                    wall_time + time.perf_counter() - start,
+                    cpu_time,
+                )
+                file_report["process_peak_rss"] = peak_rss
+            except Exception as e:  # pylint: disable=broad-except
+                record_result(input_filename, e)
+                continue
+            record_result(input_filename, None, record, file_report)
+
+    async def run_stage(workers: list, next_queue: asyncio.Queue | None, next_workers: int) -> None:
+        # once all the workers of a stage are done, each worker of the next stage gets a None to stop
+        await asyncio.gather(*workers)
+        if next_queue is not None:
+            for _ in range(next_workers):
+                await next_queue.put(None)
+
+    executor: ThreadPoolExecutor | ProcessPoolExecutor
+    stage_engine: MetaguidingEngine | None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs, initializer=_init_worker_engine, initargs=(engine,))
+        stage_engine = None
+    else:
+        executor = ThreadPoolExecutor(1, thread_name_prefix="metaguiding-pipeline")
+        stage_engine = engine
+    with executor:
+        await asyncio.gather(
+            run_stage([find_files()], task_queue, _PIPELINE_IO_TASKS),
+            run_stage([read_files() for _ in range(_PIPELINE_IO_TASKS)], read_queue, jobs),
+            run_stage([metaguide_files(executor, stage_engine) for _ in range(jobs)], write_queue, _PIPELINE_IO_TASKS),
+            run_stage([write_files() for _ in range(_PIPELINE_IO_TASKS)], None, 0),
+        )
+
+
+class MetaguideDirReport:
+    """What metaguide_dir did, for capacity planning. Returned by metaguide_dir, and written as JSON with
+    write_json.
+
+    files: list[dict]
+        A dict per file found: input, output and status ("processed", "skipped" or "error"). The processed
+        files also have wall_time in seconds, input_bytes, output_bytes, chapters (xhtml documents
+        metaguided) and words (words bolded, or unbolded). Their process_cpu_time and process_peak_rss are
+        measured on the process that metaguided the file, not on the file alone: the CPU time, in seconds,
+        that the process used while the file was metaguided, which includes the reads and writes of other
+        files in the pipeline with 1 job, and the peak resident memory, in bytes, of the process so far
+        (None if unknown), which includes the files it processed before. The errors have error
+    files_processed, files_skipped, files_with_errors: int
+        The number of files of each status
+    wall_time, cpu_time: float
+        The time metaguide_dir took, and the CPU time it used in its process and worker processes, in seconds
+    """
+
+    def __init__(self, input_dir: str, output_dir: str, engine_id: str, jobs: int) -> None:
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.engine = engine_id
+        self.jobs = jobs
+        self.files: list[dict] = []
+        self.files_processed = 0
+        self.files_skipped = 0
+        self.files_with_errors = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def add_processed(self, file_report: dict) -> None:
+        self.files.append(file_report)
+        self.files_processed += 1
+
+    def add_skipped(self, input_filename: str, output_filename: str) -> None:
+        self.files.append({"input": input_filename, "output": output_filename, "status": "skipped"})
+        self.files_skipped += 1
+
+    def add_error(self, input_filename: str, error: BaseException) -> None:
+        self.files.append({"input": input_filename, "status": "error", "error": repr(error)})
+        self.files_with_errors += 1
+
+    def _sum(self, key: str) -> int | float:
+        return sum(file_report.get(key) or 0 for file_report in self.files)
+
+    def to_dict(self) -> dict:
+        """The report and its totals: input_bytes, output_bytes, chapters and words are summed over the
+        processed files, peak_rss is the highest of the processes, and the throughputs are per second of
+        wall_time"""
+        wall_time = max(self.wall_time, 1e-9)
+        input_bytes = self._sum("input_bytes")
+        words = self._sum("words")
+        peak_rss: list[int] = [
+            file_report["process_peak_rss"] for file_report in self.files if file_report.get("process_peak_rss")
+        ]
+        return {
+            "input_dir": self.input_dir,
+            "output_dir": self.output_dir,
+            "engine": self.engine,
+            "jobs": self.jobs,
+            "files_processed": self.files_processed,
+            "files_skipped": self.files_skipped,
+            "files_with_errors": self.files_with_errors,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "input_bytes": input_bytes,
+            "output_bytes": self._sum("output_bytes"),
+            "chapters": self._sum("chapters"),
+            "words": words,
+            "peak_rss": max([*peak_rss, _get_peak_rss() or 0]) or None,
+            "throughput_mb_per_second": input_bytes / 1024 / 1024 / wall_time,
+            "words_per_second": words / wall_time,
+            "files": self.files,
+        }
+
+    def write_json(self, filename: str) -> None:
+        """Write the report, with its totals, to a JSON file"""
+        with _open_output_file(filename) as report_writer:
+            report_writer.write(json.dumps(self.to_dict(), indent=2, ensure_ascii=False).encode("utf-8"))
+
+
+def metaguide_dir(
+    input_dir: str,
+    output_dir: str,
+    *,
+    remove_metaguiding: bool = False,
+    engine: MetaguidingEngine | str | None = None,
+    jobs: int = 1,
+    use_manifest: bool = True,
+    pipeline: bool = False,
+    report_file: str | None = None,
+) -> MetaguideDirReport:
+    """Metaguides all epubs and xhtml found in a directory (recursively). All the files are found first, and
+    processed from the one with the most xhtml to metaguide to the one with the least
     input_dir: str
         The input epub/xhtml directory
     output_dir: str
         The output epub/xhtml directory
     remove_metaguiding: bool
         If True, removes metaguiding from the files
+    engine: MetaguidingEngine | str | None
+        The engine, or the name of a registered engine. None uses the engine chosen by set_metaguiding_engine
+    jobs: int
+        The number of files processed at once, each by a worker process with its own copy of the engine.
+        1, the default, processes them one after another in the calling process. The engine must be
+        picklable, and the worker processes must be able to import this module
+    use_manifest: bool
+        If True, the files processed are recorded in a manifest in output_dir. On the next runs, the inputs
+        that did not change are skipped, and the ones that changed are processed again, replacing their
+        output. Without a record, a file whose output already exists is skipped
+    pipeline: bool
+        If True, the files are read, metaguided and written by overlapping stages run by asyncio, so reading
+        and writing the files hides behind the metaguiding of the others, e.g. on spinning disks or network
+        drives. Each file is in memory, whole, while it is processed. Cannot be used from a running event loop
+    report_file: str | None
+        If given, the report is also written to this file as JSON
+    return: MetaguideDirReport
+        The status, timings, sizes and counts of each file, and their totals
     """
+    if jobs < 1:
+        msg = f"Unsupported number of jobs {jobs}, expected at least 1"
+        raise ValueError(msg)
 
     # get a list of all the files in the directory, and the child directories if recursive
     # verify if the file is a file and if it has the correct extension
@@ -459,43 +2495,127 @@ def metaguide_dir(input_dir: str, output_dir: str, *, remove_metaguiding: bool =
                 yield from get_files(input_filename, recursive)
 
     _logger.info(f"Processing files in {input_dir} to {output_dir} (recursively)")
-
-    files_processed = 0
-    files_skipped = 0
-    files_with_errors = 0
+    start, cpu_start = time.perf_counter(), _get_cpu_time()
+    # the engine is created once, so its caches and stats cover the whole directory
+    engine = _resolve_engine(engine)
 
     # check if the output directory exists and if not create it
     if not os.path.exists(output_dir):
         _logger.info(f"Creating {output_dir}")
         os.makedirs(output_dir)
 
-    for input_filename in get_files(input_dir, True):
-        output_filename = os.path.join(output_dir, os.path.basename(input_filename))
-        _logger.debug(f"Processing {input_filename} to {output_filename}")
-
-        # verify if the output file already exists
-        if os.path.isfile(output_filename):
-            _logger.warning(f"Skipping {input_filename} because {output_filename} already exists")
-            files_skipped += 1
-            continue
-
-        try:
-            with open(input_filename, "rb") as input_reader:
-                input_file_stream = BytesIO(input_reader.read())
-                if os.path.splitext(input_filename)[-1].upper() in _EPUB_EXTENSIONS:
-                    output_file_stream = metaguide_epub_stream(input_file_stream, remove_metaguiding=remove_metaguiding)
-                else:
-                    output_file_stream = metaguide_xhtml_stream(
-                        input_file_stream, remove_metaguiding=remove_metaguiding
-                    )
-                with open(output_filename, "wb") as output_writer:
-                    output_writer.write(output_file_stream.read())
-            files_processed += 1
-        except Exception as e:  # pylint: disable=broad-except
+    manifest = _DirManifest(output_dir) if use_manifest else None
+    engine_id = _get_engine_id(engine, remove_metaguiding=remove_metaguiding)
+    report = MetaguideDirReport(input_dir, output_dir, engine_id, jobs)
+
+    def record_result(
+        input_filename: str,
+        error: BaseException | None,
+        record: dict | None = None,
+        file_report: dict | None = None,
+    ) -> None:
+        if error is None:
+            if file_report is not None:
+                report.add_processed(file_report)
+            if manifest is not None and record is not None:
+                manifest.add(record)
+        else:
             # pylint: disable=logging-fstring-interpolation
-            files_with_errors += 1
-            _logger.exception(f"Error processing {input_filename}", e)
-            continue
+            report.add_error(input_filename, error)
+            # the calibre plugins replace _logger with a logger that takes the message only, so the traceback,
+            # of an error that may come from a worker process, is part of it
+            error_traceback = "".join(traceback.format_exception(error)).rstrip()
+            _logger.error(f"Error processing {input_filename}\n{error_traceback}")
+
+    # the outputs of the files processed or being processed may not exist yet, but the next files with
+    # the same name are skipped
+    submitted_outputs: set[str] = set()
+
+    def get_tasks() -> Generator[tuple[str, str, str], None, None]:
+        # the files to process: (input_filename, output_filename, input_key)
+        for input_filename in get_files(input_dir, True):
+            output_filename = os.path.join(output_dir, os.path.basename(input_filename))
+            input_key = os.path.relpath(input_filename, input_dir)
+            _logger.debug(f"Processing {input_filename} to {output_filename}")
+
+            up_to_date = None
+            if manifest is not None and output_filename not in submitted_outputs:
+                up_to_date = manifest.is_up_to_date(input_key, input_filename, output_filename, engine_id)
+            if up_to_date:
+                _logger.debug(f"Skipping {input_filename} because it did not change since {output_filename} was made")
+                report.add_skipped(input_filename, output_filename)
+                continue
+
+            # verify if the output file already exists, unless it was made from an older version of the input
+            if (up_to_date is None and os.path.isfile(output_filename)) or output_filename in submitted_outputs:
+                _logger.warning(f"Skipping {input_filename} because {output_filename} already exists")
+                report.add_skipped(input_filename, output_filename)
+                continue
+
+            submitted_outputs.add(output_filename)
+            yield input_filename, output_filename, input_key
+
+    # all the files are found before the first one is processed, to start with the largest ones
+    tasks = _schedule_dir_tasks(get_tasks(), engine, jobs=jobs, remove_metaguiding=remove_metaguiding)
+    if pipeline:
+        asyncio.run(
+            _metaguide_dir_pipeline(
+                tasks,
+                engine,
+                record_result,
+                jobs=jobs,
+                remove_metaguiding=remove_metaguiding,
+                use_manifest=use_manifest,
+            )
+        )
+    elif jobs > 1:
+        # the files are submitted to the pool in the scheduled order and counted as they finish
+        _logger.info(f"Processing files with {jobs} worker processes")
+        with ProcessPoolExecutor(jobs, initializer=_init_worker_engine, initargs=(engine,)) as executor:
+            futures = {
+                executor.submit(
+                    _metaguide_dir_file_in_worker,
+                    input_filename,
+                    output_filename,
+                    remove_metaguiding,
+                    input_key,
+                    use_manifest,
+                ): input_filename
+                for input_filename, output_filename, input_key in tasks
+            }
+            for future in as_completed(futures):
+                error = future.exception()
+                record_result(futures[future], error, *(() if error else future.result()))
+    else:
+        for input_filename, output_filename, input_key in tasks:
+            try:
+                record, file_report = _metaguide_dir_file(
+                    input_filename,
+                    output_filename,
+                    engine,
+                    remove_metaguiding=remove_metaguiding,
+                    input_key=input_key,
+                    use_manifest=use_manifest,
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                record_result(input_filename, e)
+            else:
+                record_result(input_filename, None, record, file_report)
+
+    if manifest is not None:
+        manifest.compact()
+
+    report.wall_time = time.perf_counter() - start
+    report.cpu_time = _get_cpu_time() - cpu_start
+    totals = report.to_dict()
+    _logger.info(
+        f"Processed {report.files_processed} files, skipped {report.files_skipped}, "
+        f"{report.files_with_errors} with errors in {report.wall_time:.1f} s: "
+        f"{totals['throughput_mb_per_second']:.2f} MB/s, {totals['words_per_second']:.0f} words/s"
+    )
+    if report_file is not None:
+        report.write_json(report_file)
+    return report
 
 
 def is_file_metaguided(filepath: str) -> bool:
@@ -513,9 +2633,7 @@ def is_file_metaguided(filepath: str) -> bool:
     _ensure_file_exists(filepath)
     _ensure_allowed_extension(filepath, _EPUB_EXTENSIONS)
 
+    # zipfile reads the central directory from the end of the file, the entries are not read,
+    # so the time taken does not depend on the size of the book
     with open(filepath, "rb") as input_reader:
-        input_file_stream = BytesIO(input_reader.read())
-        with zipfile.ZipFile(input_file_stream, "r", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as input_zip:
-            epub_item_files = _get_epub_item_files_from_zip(input_zip)
-            is_metaguided, _ = _check_flag_file(epub_item_files)
-            return is_metaguided
+        return _is_epub_stream_metaguided(input_reader)